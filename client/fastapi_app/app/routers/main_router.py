@@ -4,7 +4,7 @@ import logging
 from typing import List
 import json
 import fastapi
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, status, Query
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer, OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.sql import crud
@@ -21,7 +21,8 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from global_variables.global_variables import rabbitmq_working, system_values
 from global_variables.global_variables import get_rabbitmq_status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.sql.database import SessionLocal
 
 
 logger = logging.getLogger(__name__)
@@ -398,3 +399,52 @@ async def delete_user(
     await rabbitmq_publish_logs.publish_log(message_body, routing_key)
     return {"message": "User deleted successfully"}
 
+
+CLIENT_SNAPSHOT_MAX_LIMIT = 1000000
+
+
+@router.get(
+    "/clients/snapshot",
+    summary="Streamed snapshot of the client addresses",
+    responses={
+        status.HTTP_200_OK: {
+            "description": "{id_client, address, zip_code} of every client after after_id, sorted by id, as "
+                           "NDJSON. X-High-Water-Mark is the seq of the last client event before the snapshot."
+        }
+    }
+)
+async def get_clients_snapshot(
+    after_id: int = Query(None, description="Return clients with id greater than this"),
+    limit: int = Query(None, ge=1, le=CLIENT_SNAPSHOT_MAX_LIMIT, description="Maximum number of clients"),
+    db: AsyncSession = Depends(dependencies.get_db),
+    user: dict = Depends(get_current_user)
+):
+    if user.get("role") != "admin":
+        data = {
+            "message": "ERROR - Not authorized"
+        }
+        message_body = json.dumps(data)
+        routing_key = "client.snapshot.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
+
+    # Antes de leer las direcciones: los eventos con seq mayor pueden no estar en el snapshot
+    high_water_mark = await crud.get_high_water_mark(db)
+
+    async def ndjson():
+        # Sesion propia: la de Depends se cierra antes de enviar la respuesta
+        async with SessionLocal() as stream_db:
+            async for address in crud.stream_client_addresses(stream_db, after_id, limit):
+                yield json.dumps(address) + "\n"
+
+    data = {
+        "message": "INFO - Client snapshot requested"
+    }
+    message_body = json.dumps(data)
+    routing_key = "client.snapshot.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return StreamingResponse(
+        ndjson(),
+        media_type="application/x-ndjson",
+        headers={"X-High-Water-Mark": str(high_water_mark)}
+    )
@@ -6,6 +6,7 @@ from typing import Optional
 import json
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.sql import func
 from app.sql import models
 from passlib.context import CryptContext
 from app.routers import rabbitmq
@@ -109,15 +110,18 @@ async def create_user(db: AsyncSession, user: schemas.UserCreate):
 
     # Add the new user to the database
     db.add(db_user)
+    await db.flush()  # Get the auto-generated ID
+    routing_key = "client.created"
+    seq = await record_client_event(db, db_user.id, routing_key)
     await db.commit()
-    await db.refresh(db_user)  # Refresh to get the auto-generated ID
+    await db.refresh(db_user)
     data = {
         "id_client": db_user.id,
         "address": db_user.address,
-        "zip_code": db_user.zip_code
+        "zip_code": db_user.zip_code,
+        "seq": seq
     }
     message_body = json.dumps(data)
-    routing_key = "client.created"
     await rabbitmq.publish(message_body, routing_key)
     return db_user
 
@@ -128,20 +132,50 @@ async def update_user(db: AsyncSession, client_id, client):
     db_user.email = client.email
     db_user.address = client.address
     db_user.zip_code = int(client.zip_code)
+    routing_key = "client.updated"
+    seq = await record_client_event(db, db_user.id, routing_key)
     await db.commit()
     await db.refresh(db_user)
     data = {
         "id_client": db_user.id,
         "address": db_user.address,
-        "zip_code": db_user.zip_code
+        "zip_code": db_user.zip_code,
+        "seq": seq
     }
     message_body = json.dumps(data)
-    routing_key = "client.updated"
     await rabbitmq.publish(message_body, routing_key)
     return db_user
 
 
 
+async def record_client_event(db: AsyncSession, id_client, routing_key):
+    """Add a client event to the log in the current transaction and return its seq."""
+    event = models.ClientEvent(id_client=id_client, routing_key=routing_key)
+    db.add(event)
+    await db.flush()
+    return event.seq
+
+
+async def get_high_water_mark(db: AsyncSession):
+    """Return the seq of the last client event (0 if none)."""
+    result = await db.execute(select(func.max(models.ClientEvent.seq)))
+    return result.scalar() or 0
+
+
+async def stream_client_addresses(db: AsyncSession, after_id=None, limit=None, batch_size: int = 1000):
+    """Yield {"id_client", "address", "zip_code"} of the users sorted by id, fetching `batch_size` rows at a time."""
+    stmt = select(
+        models.User.id.label("id_client"), models.User.address, models.User.zip_code
+    ).order_by(models.User.id)
+    if after_id is not None:
+        stmt = stmt.where(models.User.id > after_id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    result = await db.stream(stmt.execution_options(yield_per=batch_size))
+    async for row in result.mappings():
+        yield dict(row)
+
+
 async def get_user_by_username(db: AsyncSession, username: str) -> Optional[models.User]:
     """Get a user by username."""
     result = await db.execute(select(models.User).filter(models.User.username == username))
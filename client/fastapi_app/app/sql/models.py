@@ -49,4 +49,15 @@ class User(Base):
             "id": self.id,
             "username": self.username,
             "creation_date": self.creation_date
-        }
\ No newline at end of file
+        }
+
+
+class ClientEvent(Base):
+    """Log of the client.* events published, numbered by seq (the high-water mark of the snapshots)."""
+    __tablename__ = "client_events"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    id_client = Column(Integer, nullable=False)
+    routing_key = Column(String(256), nullable=False)
+    creation_date = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Bootstrap of the user_address replica from the client service snapshot.
+
+When the bootstrap has not completed yet (new or wiped replica), the addresses are bulk-loaded from
+the client service (GET /clients/snapshot, NDJSON pages of ADDRESS_BOOTSTRAP_PAGE_SIZE clients)
+before the client.* consumers start. The progress (high-water mark and last id_client loaded) is
+stored in address_bootstrap after every batch, so a bootstrap that fails partway is resumed on the
+next start, and it is marked complete only after the last page. The high-water mark of the snapshot
+is handed to the address event batcher, which then skips the events already included in it.
+"""
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+import httpx
+from jose import jwt
+from app.consulService.BLConsul import get_consul_service
+from app.sql import crud
+from app.sql.database import SessionLocal
+from app.business_logic.address_events import address_event_batcher
+
+logger = logging.getLogger(__name__)
+
+CLIENT_SERVICE_NAME = os.getenv("CLIENT_SERVICE_NAME", "client")
+ADDRESS_BOOTSTRAP = os.getenv("ADDRESS_BOOTSTRAP", "empty")  # empty | always | never
+ADDRESS_BOOTSTRAP_PAGE_SIZE = int(os.getenv("ADDRESS_BOOTSTRAP_PAGE_SIZE", "100000"))
+ADDRESS_BOOTSTRAP_BATCH_SIZE = int(os.getenv("ADDRESS_BOOTSTRAP_BATCH_SIZE", "1000"))
+ADDRESS_BOOTSTRAP_TIMEOUT_SECONDS = float(os.getenv("ADDRESS_BOOTSTRAP_TIMEOUT_SECONDS", "60"))
+ALGORITHM = "RS256"
+
+
+def service_token():
+    """Short-lived admin token of the delivery service, signed with the shared private key."""
+    with open("/keys/priv.pem", "r") as priv_file:
+        private_key = priv_file.read()
+    return jwt.encode(
+        {
+            "username": "delivery",
+            "id_client": 0,
+            "role": "admin",
+            "exp": datetime.utcnow() + timedelta(minutes=5)
+        },
+        private_key,
+        algorithm=ALGORITHM
+    )
+
+
+async def _load_page(http_client, url, after_id, high_water_mark):
+    """Upsert a snapshot page. Returns (last id_client, rows, high-water mark of the first page)."""
+    params = {"limit": ADDRESS_BOOTSTRAP_PAGE_SIZE}
+    if after_id is not None:
+        params["after_id"] = after_id
+    rows, batch, last_id = 0, [], after_id
+    async with http_client.stream("GET", url, params=params) as response:
+        response.raise_for_status()
+        if high_water_mark is None:
+            high_water_mark = int(response.headers.get("X-High-Water-Mark", "0"))
+        async with SessionLocal() as db:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                address = json.loads(line)
+                # El snapshot refleja al menos los eventos hasta el high-water mark
+                address["seq"] = high_water_mark
+                batch.append(address)
+                if len(batch) >= ADDRESS_BOOTSTRAP_BATCH_SIZE:
+                    await crud.upsert_addresses(db, batch)
+                    rows += len(batch)
+                    last_id = batch[-1]["id_client"]
+                    await crud.save_address_bootstrap(db, high_water_mark, last_id)
+                    batch = []
+            if batch:
+                await crud.upsert_addresses(db, batch)
+                rows += len(batch)
+                last_id = batch[-1]["id_client"]
+                await crud.save_address_bootstrap(db, high_water_mark, last_id)
+    return last_id, rows, high_water_mark
+
+
+async def bootstrap_addresses():
+    """Load or resume the client addresses snapshot if needed. Returns the number of addresses loaded."""
+    if ADDRESS_BOOTSTRAP == "never":
+        return 0
+    async with SessionLocal() as db:
+        progress = await crud.get_address_bootstrap(db)
+        if ADDRESS_BOOTSTRAP != "always":
+            if progress is not None and progress.completed_at is not None:
+                address_event_batcher.high_water_mark = progress.high_water_mark
+                return 0
+            # Replica llenada por eventos antes de existir el bootstrap
+            if progress is None and await crud.count_addresses(db):
+                return 0
+    if ADDRESS_BOOTSTRAP == "always" or progress is None:
+        after_id, high_water_mark = None, None
+    else:
+        # Bootstrap interrumpido: se sigue desde el ultimo lote guardado
+        after_id, high_water_mark = progress.after_id, progress.high_water_mark
+        logger.info("Resuming address bootstrap after client %s", after_id)
+    service = get_consul_service(CLIENT_SERVICE_NAME)
+    if service["Address"] is None:
+        logger.error("Address bootstrap skipped: client service not found in Consul")
+        return 0
+    url = f"https://{service['Address']}:{service['Port']}/clients/snapshot"
+    headers = {"Authorization": f"Bearer {service_token()}"}
+
+    loaded = 0
+    async with httpx.AsyncClient(
+        verify=False, headers=headers, timeout=ADDRESS_BOOTSTRAP_TIMEOUT_SECONDS
+    ) as http_client:
+        while True:
+            after_id, rows, high_water_mark = await _load_page(http_client, url, after_id, high_water_mark)
+            loaded += rows
+            if rows < ADDRESS_BOOTSTRAP_PAGE_SIZE:
+                break
+    high_water_mark = high_water_mark or 0
+    async with SessionLocal() as db:
+        await crud.save_address_bootstrap(db, high_water_mark, after_id, datetime.utcnow())
+    # Los eventos hasta el high-water mark ya estan en el snapshot
+    address_event_batcher.high_water_mark = high_water_mark
+    logger.info("Address bootstrap loaded %i addresses up to event %i", loaded, address_event_batcher.high_water_mark)
+    return loaded
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Micro-batching of the client.created / client.updated events.
+
+Events are kept unacknowledged for up to ADDRESS_BATCH_WINDOW_SECONDS (or until
+ADDRESS_BATCH_MAX_EVENTS arrive), coalesced per id_client keeping the latest one, and written with a
+single upsert. The messages of the window are acknowledged after the commit, or requeued if it
+fails; the seq stored with every address keeps a requeued older event from overwriting a newer
+one written meanwhile. Events numbered (seq) up to the high-water mark of the address bootstrap are already in the
+database and are skipped.
+"""
+import asyncio
+import json
+import logging
+import os
+from app.sql import crud
+from app.sql.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+ADDRESS_BATCH_WINDOW_SECONDS = float(os.getenv("ADDRESS_BATCH_WINDOW_SECONDS", "0.2"))
+ADDRESS_BATCH_MAX_EVENTS = int(os.getenv("ADDRESS_BATCH_MAX_EVENTS", "500"))
+
+
+class AddressEventBatcher:
+    """Coalesces address events per client and flushes them in windows."""
+
+    def __init__(self, window: float = ADDRESS_BATCH_WINDOW_SECONDS, max_events: int = ADDRESS_BATCH_MAX_EVENTS):
+        self.window = window
+        self.max_events = max_events
+        self._latest = {}
+        self._seqs = {}
+        self._messages = []
+        self.high_water_mark = 0
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self.events = 0
+        self.flushes = 0
+        self.rows = 0
+        self.skipped = 0
+
+    async def add(self, message):
+        """Take an unacknowledged client event."""
+        try:
+            client = json.loads(message.body)
+            address = {
+                "id_client": client['id_client'],
+                "address": client['address'],
+                "zip_code": client['zip_code'],
+                "seq": client.get('seq')
+            }
+        except (ValueError, KeyError) as exc:
+            logger.error(f"Discarding malformed client event: {exc}")
+            await message.reject()
+            return
+        seq = client.get('seq') or 0
+        if seq and seq <= self.high_water_mark:
+            await message.ack()
+            self.skipped += 1
+            return
+        # El ultimo evento de cada cliente sustituye a los anteriores de la ventana
+        if seq >= self._seqs.get(address["id_client"], 0):
+            self._latest[address["id_client"]] = address
+            self._seqs[address["id_client"]] = seq
+        self._messages.append(message)
+        self.events += 1
+        if len(self._messages) >= self.max_events:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Upsert the coalesced addresses and acknowledge their messages."""
+        async with self._lock:
+            if not self._messages:
+                return
+            addresses, messages = list(self._latest.values()), self._messages
+            self._latest, self._seqs, self._messages = {}, {}, []
+            try:
+                async with SessionLocal() as db:
+                    await crud.upsert_addresses(db, addresses)
+            except Exception as exc:
+                logger.error(f"Error upserting {len(addresses)} addresses: {exc}")
+                for message in messages:
+                    await message.nack(requeue=True)
+                return
+            for message in messages:
+                await message.ack()
+            self.flushes += 1
+            self.rows += len(addresses)
+
+    def stats(self):
+        return {
+            "events": self.events,
+            "flushes": self.flushes,
+            "rows": self.rows,
+            "skipped": self.skipped,
+            "high_water_mark": self.high_water_mark,
+            "pending": len(self._messages)
+        }
+
+
+address_event_batcher = AddressEventBatcher()
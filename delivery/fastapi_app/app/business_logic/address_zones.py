@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""In-memory id_client -> province cache for the address checks of delivery.check.
+
+The province of a client is the zip code // 1000, and whether it is deliverable comes from a table
+precomputed from DELIVERABLE_PROVINCES. The cache is warmed from the database at startup and kept
+up to date by crud (address endpoints and client events of this replica) and by a per-replica
+subscription to client.created / client.updated. Clients without an address are cached as unknown
+for ADDRESS_NEGATIVE_TTL_SECONDS.
+"""
+import os
+import time
+
+DELIVERABLE_PROVINCES = frozenset(
+    int(province) for province in os.getenv("DELIVERABLE_PROVINCES", "1,20,48").split(",") if province.strip()
+)
+ADDRESS_NEGATIVE_TTL_SECONDS = float(os.getenv("ADDRESS_NEGATIVE_TTL_SECONDS", "30"))
+
+# Provincias 00-99 de los codigos postales
+PROVINCES = 100
+DELIVERABLE_ZONE = tuple(province in DELIVERABLE_PROVINCES for province in range(PROVINCES))
+
+MISS = object()
+UNKNOWN = None
+
+
+def province_of(zip_code):
+    return zip_code // 1000
+
+
+def is_deliverable_province(province):
+    return 0 <= province < PROVINCES and DELIVERABLE_ZONE[province]
+
+
+class AddressZoneCache:
+    """Province of every known client plus a short-lived negative cache."""
+
+    def __init__(self):
+        self._provinces = {}
+        self._seqs = {}
+        self._unknown = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def warm(self, addresses):
+        """Replace the cache with the given (id_client, zip_code, seq) addresses."""
+        self._provinces = {id_client: province_of(zip_code) for id_client, zip_code, _ in addresses}
+        self._seqs = {id_client: seq for id_client, _, seq in addresses if seq is not None}
+        self._unknown = {}
+
+    def set(self, id_client, zip_code, seq=None):
+        """Cache the address of a client, unless seq is older than the event already cached."""
+        if seq is not None:
+            if seq < self._seqs.get(id_client, 0):
+                return
+            self._seqs[id_client] = seq
+        self._provinces[id_client] = province_of(zip_code)
+        self._unknown.pop(id_client, None)
+        self.updates += 1
+
+    def set_unknown(self, id_client):
+        self._provinces.pop(id_client, None)
+        self._unknown[id_client] = time.monotonic() + ADDRESS_NEGATIVE_TTL_SECONDS
+
+    def get(self, id_client):
+        """Province of the client, UNKNOWN if it has no address, or MISS if not cached."""
+        province = self._provinces.get(id_client)
+        if province is not None:
+            self.hits += 1
+            return province
+        expires = self._unknown.get(id_client)
+        if expires is not None:
+            if expires > time.monotonic():
+                self.negative_hits += 1
+                return UNKNOWN
+            del self._unknown[id_client]
+        self.misses += 1
+        return MISS
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "clients": len(self._provinces),
+            "unknown_clients": len(self._unknown),
+            "deliverable_provinces": sorted(DELIVERABLE_PROVINCES),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            "updates": self.updates
+        }
+
+
+address_zone_cache = AddressZoneCache()
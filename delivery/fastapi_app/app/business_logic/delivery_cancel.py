@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""Decision of the delivery.check_cancel command.
+
+The command is retried by the orders saga scanner, so it must be idempotent: a delivery that is
+already Canceled is answered with success again instead of being reported as not cancelable.
+"""
+from app.sql import models
+
+
+def resolve_cancel(status):
+    """Return (status to set or None, answer to orders) for a delivery in `status`."""
+    if status == models.Delivery.STATUS_CREATED:
+        return models.Delivery.STATUS_CANCELED, True
+    if status == models.Delivery.STATUS_CANCELED:
+        # Reintento de un comando ya aplicado
+        return None, True
+    return None, False
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Restart-safe timers of the deliveries in course.
+
+A delivery in course is a Delivering row with a due time (due_at) in the database. This replica keeps
+the due times in a timer wheel, loaded at startup, only to know when to look for due deliveries:
+the deliveries are then leased in batches with a conditional UPDATE (so every replica takes
+different ones), one orders.delivered event is published per batch ({"orders": [...]}) and the
+leased rows are set as Delivered. Rows of
+other replicas, or of a replica that died with a lease, are found by polling every
+DELIVERY_SCHEDULER_POLL_SECONDS.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from app.sql import crud
+from app.sql.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_TIME_SECONDS = float(os.getenv("DELIVERY_TIME_SECONDS", "10"))
+DELIVERY_SCHEDULER_TICK_SECONDS = float(os.getenv("DELIVERY_SCHEDULER_TICK_SECONDS", "1"))
+DELIVERY_SCHEDULER_POLL_SECONDS = float(os.getenv("DELIVERY_SCHEDULER_POLL_SECONDS", "5"))
+DELIVERY_TIMER_WHEEL_SLOTS = int(os.getenv("DELIVERY_TIMER_WHEEL_SLOTS", "512"))
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", "500"))
+DELIVERY_LEASE_SECONDS = float(os.getenv("DELIVERY_LEASE_SECONDS", "30"))
+
+
+def as_timestamp(due_at: datetime):
+    """Epoch seconds of a naive UTC datetime."""
+    return due_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TimerWheel:
+    """Hashed timer wheel of due ticks. Only counts how many timers expire at each tick."""
+
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._cursor = int(time.time() // tick)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, due_timestamp: float):
+        due_tick = max(int(due_timestamp // self.tick), self._cursor)
+        self._slots[due_tick % len(self._slots)].append(due_tick)
+        self._size += 1
+
+    def advance(self, now_timestamp: float):
+        """Move the wheel up to now and return the number of expired timers."""
+        expired = 0
+        now_tick = int(now_timestamp // self.tick)
+        while self._cursor <= now_tick:
+            index = self._cursor % len(self._slots)
+            bucket = self._slots[index]
+            if bucket:
+                # Los timers de vueltas posteriores se quedan en el slot
+                pending = [due_tick for due_tick in bucket if due_tick > self._cursor]
+                expired += len(bucket) - len(pending)
+                self._slots[index] = pending
+            self._cursor += 1
+        self._size -= expired
+        return expired
+
+
+class DeliveryScheduler:
+    """Fires the due deliveries of every replica in leased batches."""
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.wheel = TimerWheel(DELIVERY_SCHEDULER_TICK_SECONDS, DELIVERY_TIMER_WHEEL_SLOTS)
+        self.delivered = 0
+        self.batches = 0
+        self.publish_errors = 0
+        self._last_poll = 0.0
+
+    async def load(self):
+        """Load the due times of the deliveries in course (e.g. after a restart)."""
+        async with SessionLocal() as db:
+            # Entregas que quedaron Delivering antes de existir due_at
+            await crud.schedule_unscheduled_deliveries(db, datetime.utcnow())
+            due_times = await crud.get_due_times(db)
+        for due_at in due_times:
+            self.wheel.add(as_timestamp(due_at))
+        logger.info("Delivery scheduler loaded %i deliveries in course", len(due_times))
+
+    async def schedule_wave(self, order_ids):
+        """Start the deliveries of a wave with a single timer. Returns [(order_id, id_client)] of the started ones."""
+        due_at = datetime.utcnow() + timedelta(seconds=DELIVERY_TIME_SECONDS)
+        async with SessionLocal() as db:
+            scheduled = await crud.schedule_deliveries(db, order_ids, due_at)
+        if scheduled:
+            self.wheel.add(as_timestamp(due_at))
+        return scheduled
+
+    async def fire_due(self):
+        """Deliver every due delivery, DELIVERY_BATCH_SIZE at a time."""
+        while True:
+            now = datetime.utcnow()
+            async with SessionLocal() as db:
+                leased = await crud.lease_due_deliveries(
+                    db, self.owner, now, now + timedelta(seconds=DELIVERY_LEASE_SECONDS), DELIVERY_BATCH_SIZE
+                )
+                if not leased:
+                    return
+                from app.routers.rabbitmq import publish_event  # pylint: disable=import-outside-toplevel
+                message_body = json.dumps({
+                    "orders": [{"id_order": order_id, "id_client": id_client} for order_id, id_client in leased]
+                })
+                try:
+                    await publish_event(message_body, "orders.delivered")
+                except Exception as exc:
+                    # Siguen reservadas y se reintentan cuando caduque el lease
+                    logger.error(f"Error publishing {len(leased)} delivered orders: {exc}")
+                    self.publish_errors += len(leased)
+                    return
+                completed = await crud.complete_leased_deliveries(
+                    db, self.owner, [order_id for order_id, _ in leased]
+                )
+            self.batches += 1
+            self.delivered += len(completed)
+            if len(leased) < DELIVERY_BATCH_SIZE:
+                return
+
+    async def run(self):
+        """Advance the wheel every tick and fire the due deliveries."""
+        while True:
+            await asyncio.sleep(DELIVERY_SCHEDULER_TICK_SECONDS)
+            try:
+                expired = self.wheel.advance(time.time())
+                now = time.monotonic()
+                if expired or now - self._last_poll >= DELIVERY_SCHEDULER_POLL_SECONDS:
+                    self._last_poll = now
+                    await self.fire_due()
+            except Exception as exc:
+                logger.error(f"Error firing due deliveries: {exc}")
+
+    def stats(self):
+        """Timers in the wheel of this replica and delivery counters."""
+        return {
+            "owner": self.owner,
+            "timers": len(self.wheel),
+            "delivered": self.delivered,
+            "batches": self.batches,
+            "publish_errors": self.publish_errors
+        }
+
+
+delivery_scheduler = DeliveryScheduler()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Wave dispatching of the produced orders.
+
+orders.produced messages are kept unacknowledged for up to DELIVERY_WAVE_WINDOW_SECONDS (or until
+DELIVERY_WAVE_MAX_ORDERS arrive) and grouped by the province of the client (from the address zone
+cache). Each province is a wave: its deliveries are started with a single UPDATE and a single timer
+(see delivery_scheduler), and one orders.delivering event {"province", "orders": [...]} is
+published for it. The messages are acknowledged once every wave of the window is started.
+"""
+import asyncio
+import json
+import logging
+import os
+from app.business_logic.address_zones import address_zone_cache, MISS, UNKNOWN
+from app.business_logic.delivery_scheduler import delivery_scheduler
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_WAVE_WINDOW_SECONDS = float(os.getenv("DELIVERY_WAVE_WINDOW_SECONDS", "1"))
+DELIVERY_WAVE_MAX_ORDERS = int(os.getenv("DELIVERY_WAVE_MAX_ORDERS", "500"))
+
+# Ola de los clientes cuya provincia no esta en la cache
+UNKNOWN_PROVINCE = -1
+
+
+class DeliveryWaveDispatcher:
+    """Groups the produced orders of a window into one wave per province."""
+
+    def __init__(self, window: float = DELIVERY_WAVE_WINDOW_SECONDS, max_orders: int = DELIVERY_WAVE_MAX_ORDERS):
+        self.window = window
+        self.max_orders = max_orders
+        self._waves = {}
+        self._messages = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self.orders = 0
+        self.waves = 0
+        self.scheduled = 0
+
+    async def add(self, message):
+        """Take an unacknowledged orders.produced message ({"id_order", "id_client"} or {"orders": [...]})."""
+        try:
+            event = json.loads(message.body)
+            orders = [(order['id_order'], order['id_client']) for order in event.get('orders', [event])]
+        except (ValueError, KeyError) as exc:
+            logger.error(f"Discarding malformed produced event: {exc}")
+            await message.reject()
+            return
+        for id_order, id_client in orders:
+            province = address_zone_cache.get(id_client)
+            if province is MISS or province is UNKNOWN:
+                province = UNKNOWN_PROVINCE
+            self._waves.setdefault(province, []).append(id_order)
+        self._messages.append(message)
+        self.orders += len(orders)
+        if sum(len(order_ids) for order_ids in self._waves.values()) >= self.max_orders:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def _dispatch_wave(self, province, order_ids):
+        from app.routers.rabbitmq import publish_event  # pylint: disable=import-outside-toplevel
+        scheduled = await delivery_scheduler.schedule_wave(order_ids)
+        if scheduled:
+            message_body = json.dumps({
+                "province": province,
+                "orders": [{"id_order": order_id, "id_client": id_client} for order_id, id_client in scheduled]
+            })
+            await publish_event(message_body, "orders.delivering")
+        return len(scheduled)
+
+    async def flush(self):
+        """Start every wave of the window and acknowledge its messages."""
+        async with self._lock:
+            if not self._messages:
+                return
+            waves, messages = self._waves, self._messages
+            self._waves, self._messages = {}, []
+            try:
+                scheduled = await asyncio.gather(
+                    *(self._dispatch_wave(province, order_ids) for province, order_ids in waves.items())
+                )
+            except Exception as exc:
+                # Reintento completo: volver a programar una entrega solo le da un nuevo due_at
+                logger.error(f"Error dispatching delivery waves: {exc}")
+                for message in messages:
+                    await message.nack(requeue=True)
+                return
+            for message in messages:
+                await message.ack()
+            self.waves += len(waves)
+            self.scheduled += sum(scheduled)
+
+    def stats(self):
+        return {
+            "orders": self.orders,
+            "waves": self.waves,
+            "scheduled": self.scheduled,
+            "mean_wave_size": self.scheduled / self.waves if self.waves else 0.0,
+            "pending_orders": sum(len(order_ids) for order_ids in self._waves.values())
+        }
+
+
+delivery_wave_dispatcher = DeliveryWaveDispatcher()
@@ -10,8 +10,11 @@ from .consulService.BLConsul import register_consul_service
 from .consulService.BLConsul import unregister_consul_service
 from fastapi import FastAPI
 from app.routers import main_router, rabbitmq, rabbitmq_publish_logs
-from app.sql import models
+from app.sql import models, crud
 from app.sql import database
+from app.business_logic.delivery_scheduler import delivery_scheduler
+from app.business_logic.address_zones import address_zone_cache
+from app.business_logic.address_bootstrap import bootstrap_addresses
 import global_variables
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 
@@ -62,6 +65,10 @@ async def startup_event():
         logger.info("antes del subscribe")
         async with database.engine.begin() as conn:
             await conn.run_sync(models.Base.metadata.create_all)
+            await conn.run_sync(models.add_missing_columns)
+            await conn.run_sync(models.create_missing_indexes)
+        async with database.SessionLocal() as db:
+            address_zone_cache.warm(await crud.get_address_zip_codes(db))
         await rabbitmq.subscribe_channel()
         await rabbitmq_publish_logs.subscribe_channel()
         register_consul_service()
@@ -72,8 +79,15 @@ async def startup_event():
         asyncio.create_task(rabbitmq.subscribe_revert_order_cancel())
         asyncio.create_task(rabbitmq.subscribe_produced())
         asyncio.create_task(rabbitmq.subscribe_order_cancel_delivery_pending())
+        try:
+            await bootstrap_addresses()
+        except Exception as e:
+            logger.error(f"Error en el bootstrap de direcciones: {e}")
         asyncio.create_task(rabbitmq.subscribe_client_updated())
         asyncio.create_task(rabbitmq.subscribe_client_created())
+        asyncio.create_task(rabbitmq.subscribe_address_cache())
+        await delivery_scheduler.load()
+        asyncio.create_task(delivery_scheduler.run())
 
         data = {
             "message": "INFO - Servicio Delivery inicializado correctamente"
@@ -11,6 +11,10 @@ from app.sql import schemas
 import json
 from .router_utils import raise_and_log_error
 from app.routers import rabbitmq_publish_logs
+from app.business_logic.delivery_scheduler import delivery_scheduler
+from app.business_logic.delivery_waves import delivery_wave_dispatcher
+from app.business_logic.address_zones import address_zone_cache
+from app.business_logic.address_events import address_event_batcher
 from fastapi.security import HTTPBearer, OAuth2PasswordBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 from global_variables.global_variables import rabbitmq_working, system_values
@@ -324,6 +328,54 @@ async def get_delivery(
     return delivery
 
 
+@router.get(
+    "/delivery/scheduler",
+    summary="Delivery scheduler metrics",
+    status_code=status.HTTP_200_OK,
+    tags=["Delivery"]
+)
+async def get_delivery_scheduler(
+    current_user: dict = Depends(get_current_user),
+):
+    """Timers of this replica, deliveries fired by it and delivery waves."""
+    if current_user["role"] != "admin":
+        data = {
+            "message": "ERROR - You don't have permissions"
+        }
+        message_body = json.dumps(data)
+        routing_key = "delivery.scheduler.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
+    return {
+        **delivery_scheduler.stats(),
+        "waves": delivery_wave_dispatcher.stats()
+    }
+
+
+@router.get(
+    "/delivery/address-cache",
+    summary="Address zone cache metrics",
+    status_code=status.HTTP_200_OK,
+    tags=["Address"]
+)
+async def get_address_cache(
+    current_user: dict = Depends(get_current_user),
+):
+    """Cached clients, deliverable provinces, hit rate of the address checks and address event batches."""
+    if current_user["role"] != "admin":
+        data = {
+            "message": "ERROR - You don't have permissions"
+        }
+        message_body = json.dumps(data)
+        routing_key = "delivery.address_cache.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
+    return {
+        **address_zone_cache.stats(),
+        "events": address_event_batcher.stats()
+    }
+
+
 @router.put(
     "/update_address",
     response_model=schemas.UserAddressBase,
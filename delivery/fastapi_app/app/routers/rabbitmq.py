@@ -3,7 +3,10 @@ import aio_pika
 import json
 from app.sql.database import SessionLocal  # pylint: disable=import-outside-toplevel
 from app.sql import crud, models
-from app import dependencies
+from app.business_logic.delivery_waves import delivery_wave_dispatcher
+from app.business_logic.address_zones import address_zone_cache
+from app.business_logic.address_events import address_event_batcher
+from app.business_logic.delivery_cancel import resolve_cancel
 import ssl
 import logging
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
@@ -128,39 +131,6 @@ async def subscribe_delivery_cancel():
             await on_message_delivery_cancel(message)
 
 
-async def on_produced_message(message):
-    async with message.process():
-        try:
-            # Decode the message
-            order = json.loads(message.body)
-            logger.debug(f"Processing produced message: {order}")
-
-            # Use the database session
-            async for db in dependencies.get_db():  # Consume the generator
-                # Retrieve delivery
-                logger.debug(f"Fetching delivery for order_id: {order['id_order']}")
-                db_delivery = await crud.get_delivery_by_order_id(db, order['id_order'])
-                if not db_delivery:
-                    logger.error(f"Delivery for order_id {order['id_order']} not found.")
-                    return
-
-                # Check and update the delivery status
-                if db_delivery.status != models.Delivery.STATUS_CANCELED:
-                    logger.debug(f"Updating delivery status to DELIVERING for order_id: {order['id_order']}")
-                    db_delivery = await crud.update_delivery(db, order['id_order'], models.Delivery.STATUS_DELIVERING)
-                    if db_delivery:
-                        logger.debug(f"Delivery status updated: {db_delivery.status}")
-                        # Schedule the send_product task
-                        asyncio.create_task(send_product(db_delivery))
-                    else:
-                        logger.error(f"Failed to update delivery for order_id: {order['id_order']}")
-                else:
-                    logger.info(f"Delivery for order_id {order['id_order']} is already canceled.")
-        except Exception as e:
-            logger.error(f"Error in on_produced_message: {e}")
-
-
-
 async def on_create_message(message):
     async with message.process():
 
@@ -205,10 +175,10 @@ async def subscribe_produced():
     # Bind the queue to the exchange
     routing_key = "orders.produced"
     await queue.bind(exchange=exchange_name, routing_key=routing_key)
-    # Set up a message consumer
+    # Set up a message consumer; los mensajes los confirma el dispatcher al lanzar las olas
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_produced_message(message)
+            await delivery_wave_dispatcher.add(message)
 
 
 
@@ -241,74 +211,30 @@ async def subscribe_revert_order_cancel():
 
 
 
-async def send_product(delivery):
-    logger.debug("Inicio de send_product")
-    data = {
-        "id_order": delivery.order_id,
-        "id_client": delivery.id_client
-    }
-    message_body = json.dumps(data)
-
-    # Publica el evento inicial con el estado "in process"
-    routing_key = "orders.delivering"
-    try:
-        await publish_event(message_body, routing_key)
-        logger.debug(f"Mensaje publicado en {routing_key}: {message_body}")
-    except Exception as e:
-        logger.error(f"Error al publicar el evento 'in process': {e}")
-        return
-
-    # Espera de 10 segundos
-    await asyncio.sleep(10)
-    logger.debug("Espera completada. Actualizando estado del delivery.")
-
-    # Consume the generator from `get_db`
-    try:
-        async for db in dependencies.get_db():
-            logger.debug("Sesión de base de datos creada.")
-            db_delivery = await crud.get_delivery_by_order(db, delivery.order_id)
-            if db_delivery is None:
-                logger.error(f"Delivery con ID {delivery.id} no encontrado")
-                return
-
-            db_delivery = await crud.update_delivery(db, delivery.order_id, models.Delivery.STATUS_DELIVERED)
-            if db_delivery is None:
-                logger.error(f"No se pudo actualizar el estado del delivery para ID {delivery.id}")
-                return
-
-            logger.debug(f"Estado del delivery actualizado: {db_delivery.status}")
-            break  # Ensure the loop exits after consuming the generator
-    except Exception as e:
-        logger.error(f"Error al obtener o actualizar el delivery: {e}")
-        return
-
-    # Publica el evento final con el estado "delivered"
-    routing_key = "orders.delivered"
-    try:
-        await publish_event(message_body, routing_key)
-        logger.debug(f"Mensaje publicado en {routing_key}: {message_body}")
-    except Exception as e:
-        logger.error(f"Error al publicar el evento 'delivered': {e}")
-
-
-
 async def on_message_order_cancel_delivery_pending(message):
     async with message.process():
         order = json.loads(message.body)
-        db = SessionLocal()
-        delivery = await crud.get_delivery_by_order(db, order['order_id'])
         status = False
-        if delivery.status_delivery == models.Delivery.STATUS_CREATED:
-            await crud.update_delivery(db, order['order_id'], models.Delivery.STATUS_CANCELED)
-            status = True
-        await db.close()
-        data = {
-            "order_id": order['order_id'],
-            "status": status
-        }
-        message_body = json.dumps(data)
-        routing_key = "delivery.checked_cancel"
-        await publish_response(message_body, routing_key)
+        try:
+            async with SessionLocal() as db:
+                delivery = await crud.get_delivery_by_order(db, order['order_id'])
+                if delivery is None:
+                    logger.warning(f"No delivery to cancel for order {order['order_id']}")
+                else:
+                    new_status, status = resolve_cancel(delivery.status)
+                    if new_status is not None:
+                        await crud.update_delivery(db, order['order_id'], new_status)
+        except Exception as e:
+            logger.error(f"Error al cancelar la entrega de la orden {order['order_id']}: {e}")
+        finally:
+            # orders espera siempre la respuesta para avanzar la saga
+            data = {
+                "order_id": order['order_id'],
+                "status": status
+            }
+            message_body = json.dumps(data)
+            routing_key = "delivery.checked_cancel"
+            await publish_response(message_body, routing_key)
 
 
 async def subscribe_order_cancel_delivery_pending():
@@ -324,20 +250,6 @@ async def subscribe_order_cancel_delivery_pending():
             await on_message_order_cancel_delivery_pending(message)
 
 
-async def on_client_updated_message(message):
-    async with message.process():
-        client = json.loads(message.body)
-
-        db = SessionLocal()
-        info_client = models.Client(
-            id_client=client['id_client'],
-            address=client['address'],
-            zip_code=client['zip_code']
-        )
-        await crud.update_address(db, info_client)
-        await db.close()
-
-
 async def subscribe_client_updated():
     # Create a queue
     queue_name = "client.updated"
@@ -345,23 +257,10 @@ async def subscribe_client_updated():
     # Bind the queue to the exchange
     routing_key = "client.updated"
     await queue.bind(exchange=exchange_name, routing_key=routing_key)
-    # Set up a message consumer
+    # Set up a message consumer; los mensajes los confirma el batcher al guardar su ventana
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_client_updated_message(message)
-
-
-async def on_client_created_message(message):
-    async with message.process():
-        client = json.loads(message.body)
-        db = SessionLocal()
-        info_client = models.Client(
-            id_client=client['id_client'],
-            address=client['address'],
-            zip_code=client['zip_code']
-        )
-        await crud.update_address(db, info_client)
-        await db.close()
+            await address_event_batcher.add(message)
 
 
 async def subscribe_client_created():
@@ -371,10 +270,28 @@ async def subscribe_client_created():
     # Bind the queue to the exchange
     routing_key = "client.created"
     await queue.bind(exchange=exchange_name, routing_key=routing_key)
+    # Set up a message consumer; los mensajes los confirma el batcher al guardar su ventana
+    async with queue.iterator() as queue_iter:
+        async for message in queue_iter:
+            await address_event_batcher.add(message)
+
+
+async def on_address_cache_message(message):
+    async with message.process():
+        client = json.loads(message.body)
+        address_zone_cache.set(client['id_client'], client['zip_code'], client.get('seq'))
+
+
+async def subscribe_address_cache():
+    # Cola propia de la replica: todas las replicas reciben los cambios de direccion para su cache
+    queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+    # Bind the queue to the exchange
+    for routing_key in ("client.created", "client.updated"):
+        await queue.bind(exchange=exchange_name, routing_key=routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_client_created_message(message)
+            await on_address_cache_message(message)
 
 
 async def publish_commands(message_body, routing_key):
@@ -5,7 +5,10 @@ from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy import update
+from sqlalchemy.sql import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from . import models
+from ..business_logic.address_zones import address_zone_cache, is_deliverable_province, MISS, UNKNOWN
 import asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import update, or_, case
@@ -38,6 +41,7 @@ async def create_address(db: AsyncSession, id_client: int, address: str, zip_cod
         existing_address.zip_code = zip_code
         await db.commit()
         await db.refresh(existing_address)
+        address_zone_cache.set(id_client, zip_code)
         logger.debug("Address updated for id_client %s with address: %s", id_client, address)
         return existing_address
 
@@ -46,10 +50,69 @@ async def create_address(db: AsyncSession, id_client: int, address: str, zip_cod
     db.add(new_address)
     await db.commit()
     await db.refresh(new_address)
+    address_zone_cache.set(id_client, zip_code)
     logger.debug("Address created for id_client %s with address: %s", id_client, address)
     return new_address
 
 
+async def upsert_addresses(db: AsyncSession, addresses):
+    """Insert or replace the given {"id_client", "address", "zip_code", "seq"} addresses with one statement.
+
+    A stored address is only replaced by a newer event (higher seq), so a requeued window can not
+    bring back an old address. Addresses without seq are always applied.
+    """
+    stmt = sqlite_insert(models.UserAddress).values(addresses)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.UserAddress.id_client],
+        set_={
+            "address": stmt.excluded.address,
+            "zip_code": stmt.excluded.zip_code,
+            "seq": func.coalesce(stmt.excluded.seq, models.UserAddress.seq)
+        },
+        where=or_(
+            stmt.excluded.seq.is_(None),
+            models.UserAddress.seq.is_(None),
+            stmt.excluded.seq > models.UserAddress.seq
+        )
+    ).returning(models.UserAddress.id_client, models.UserAddress.zip_code, models.UserAddress.seq)
+    result = await db.execute(stmt)
+    written = result.all()
+    await db.commit()
+    for id_client, zip_code, seq in written:
+        address_zone_cache.set(id_client, zip_code, seq)
+    logger.debug("%i addresses upserted, %i older ones skipped", len(written), len(addresses) - len(written))
+
+
+async def count_addresses(db: AsyncSession):
+    """Return the number of stored addresses."""
+    result = await db.execute(select(func.count()).select_from(models.UserAddress))
+    return result.scalar()
+
+
+async def get_address_bootstrap(db: AsyncSession):
+    """Return the progress of the address bootstrap, or None if it never started."""
+    return await db.get(models.AddressBootstrap, 1)
+
+
+async def save_address_bootstrap(
+        db: AsyncSession, high_water_mark: int, after_id=None, completed_at: datetime = None
+):
+    """Store the progress of the address bootstrap."""
+    stmt = sqlite_insert(models.AddressBootstrap).values(
+        id=1, high_water_mark=high_water_mark, after_id=after_id, completed_at=completed_at
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.AddressBootstrap.id],
+        set_={
+            "high_water_mark": stmt.excluded.high_water_mark,
+            "after_id": stmt.excluded.after_id,
+            "completed_at": stmt.excluded.completed_at
+        }
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+
 async def get_list_statement_result(db: AsyncSession, stmt):
     """Execute given statement and return list of items."""
     result = await db.execute(stmt)
@@ -117,20 +180,31 @@ async def update_address(db: AsyncSession, id_client: int, address: Optional[str
         return None
 
     logger.debug("Address updated for id_client %s", id_client)
-    return await get_address_by_id_client(db, id_client)
+    updated_address = await get_address_by_id_client(db, id_client)
+    address_zone_cache.set(id_client, updated_address.zip_code)
+    return updated_address
 
 
 async def check_address(db: AsyncSession, id_client):
-    """Persist a new client into the database."""
-
-    address = await get_address_by_id_client(db, id_client)
-
-    provincia = address.zip_code // 1000  # Extraer código de provincia del código postal
-    if (provincia == 1 or provincia == 20 or provincia == 48):
-        address_check = True
-    else:
-        address_check = False
-    return address_check
+    """Check whether the address of a client is in a deliverable province."""
+    province = address_zone_cache.get(id_client)
+    if province is MISS:
+        address = await get_address_by_id_client(db, id_client)
+        if address is None:
+            address_zone_cache.set_unknown(id_client)
+            province = UNKNOWN
+        else:
+            address_zone_cache.set(id_client, address.zip_code)
+            province = address.zip_code // 1000  # Extraer código de provincia del código postal
+    return province is not UNKNOWN and is_deliverable_province(province)
+
+
+async def get_address_zip_codes(db: AsyncSession):
+    """Return (id_client, zip_code, seq) of every address."""
+    result = await db.execute(
+        select(models.UserAddress.id_client, models.UserAddress.zip_code, models.UserAddress.seq)
+    )
+    return result.all()
 
 
 async def get_delivery_by_order(db: AsyncSession, order_id: int):
@@ -155,6 +229,89 @@ async def update_delivery(db: AsyncSession, order_id: int, new_status: str):
     return await get_delivery_by_order_id(db, order_id)
 
 
+async def schedule_deliveries(db: AsyncSession, order_ids, due_at: datetime):
+    """Set the deliveries as Delivering until due_at with one UPDATE, skipping canceled and delivered ones.
+
+    Returns [(order_id, id_client)] of the scheduled deliveries.
+    """
+    result = await db.execute(
+        update(models.Delivery)
+        .where(
+            models.Delivery.order_id.in_(order_ids),
+            models.Delivery.status.in_([models.Delivery.STATUS_CREATED, models.Delivery.STATUS_DELIVERING])
+        )
+        .values(status=models.Delivery.STATUS_DELIVERING, due_at=due_at, lease_owner=None, lease_until=None)
+        .returning(models.Delivery.order_id, models.Delivery.id_client)
+        .execution_options(synchronize_session=False)
+    )
+    scheduled = result.all()
+    await db.commit()
+    return scheduled
+
+
+async def schedule_unscheduled_deliveries(db: AsyncSession, due_at: datetime):
+    """Give a due time to the deliveries left Delivering without one. Returns the number of deliveries."""
+    result = await db.execute(
+        update(models.Delivery)
+        .where(models.Delivery.status == models.Delivery.STATUS_DELIVERING, models.Delivery.due_at.is_(None))
+        .values(due_at=due_at)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def get_due_times(db: AsyncSession):
+    """Return the due times of the deliveries in course."""
+    result = await db.execute(
+        select(models.Delivery.due_at)
+        .where(models.Delivery.status == models.Delivery.STATUS_DELIVERING, models.Delivery.due_at.is_not(None))
+    )
+    return result.scalars().all()
+
+
+async def lease_due_deliveries(db: AsyncSession, owner: str, now: datetime, lease_until: datetime, limit: int):
+    """Reserve up to `limit` due deliveries not leased by another replica. Returns [(order_id, id_client)]."""
+    due = (
+        select(models.Delivery.order_id)
+        .where(
+            models.Delivery.status == models.Delivery.STATUS_DELIVERING,
+            models.Delivery.due_at <= now,
+            or_(models.Delivery.lease_until.is_(None), models.Delivery.lease_until < now)
+        )
+        .order_by(models.Delivery.due_at)
+        .limit(limit)
+    )
+    result = await db.execute(
+        update(models.Delivery)
+        .where(models.Delivery.order_id.in_(due.scalar_subquery()))
+        .values(lease_owner=owner, lease_until=lease_until)
+        .returning(models.Delivery.order_id, models.Delivery.id_client)
+        .execution_options(synchronize_session=False)
+    )
+    leased = result.all()
+    await db.commit()
+    return leased
+
+
+async def complete_leased_deliveries(db: AsyncSession, owner: str, order_ids):
+    """Set as Delivered the deliveries still leased by `owner`. Returns their order ids."""
+    result = await db.execute(
+        update(models.Delivery)
+        .where(
+            models.Delivery.order_id.in_(order_ids),
+            models.Delivery.lease_owner == owner,
+            models.Delivery.status == models.Delivery.STATUS_DELIVERING
+        )
+        .values(status=models.Delivery.STATUS_DELIVERED, due_at=None, lease_owner=None, lease_until=None)
+        .returning(models.Delivery.order_id)
+        .execution_options(synchronize_session=False)
+    )
+    completed = result.scalars().all()
+    await db.commit()
+    return completed
+
+
 
 
 async def delete_address(db: AsyncSession, id_client: int):
@@ -168,6 +325,7 @@ async def delete_address(db: AsyncSession, id_client: int):
         logger.debug("No address found for id_client %s. Delete skipped.", id_client)
         return False
 
+    address_zone_cache.set_unknown(id_client)
     logger.debug("Address for id_client %s deleted successfully", id_client)
     return True
 
@@ -3,7 +3,7 @@
 from datetime import datetime
 
 from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Text, CheckConstraint
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, CheckConstraint
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, CheckConstraint, Index, inspect, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -44,6 +44,9 @@ class Delivery(Base):
     STATUS_DELIVERED = "Delivered"
 
     __tablename__ = "deliveries"
+    __table_args__ = (
+        Index("ix_deliveries_due_at", "due_at"),
+    )
 
     id_client = Column(Integer, nullable=False)
     order_id = Column(Integer, primary_key=True, autoincrement=True)
@@ -52,6 +55,10 @@ class Delivery(Base):
         nullable=False,
         default=STATUS_CREATED,
     )
+    # Entregas en curso: cuando pasan a Delivered y que replica las tiene reservadas
+    due_at = Column(DateTime, nullable=True)
+    lease_owner = Column(String(256), nullable=True)
+    lease_until = Column(DateTime, nullable=True)
 
 class UserAddress(Base):
     __tablename__ = "user_address"
@@ -59,6 +66,35 @@ class UserAddress(Base):
     id_client = Column(Integer, primary_key=True)  # ID único del usuario
     address = Column(String(255), nullable=False)  # Dirección de entrega
     zip_code = Column(Integer, nullable=False)  # Código postal
+    seq = Column(Integer, nullable=True)  # seq del ultimo evento de cliente aplicado
 
     def __repr__(self):
-        return f"<UserAddress(id_client={self.id_client}, address={self.address}, zip_code={self.zip_code})>"
\ No newline at end of file
+        return f"<UserAddress(id_client={self.id_client}, address={self.address}, zip_code={self.zip_code})>"
+
+
+class AddressBootstrap(Base):
+    """Progress of the address bootstrap (a single row). completed_at is NULL until the snapshot is fully loaded."""
+    __tablename__ = "address_bootstrap"
+
+    id = Column(Integer, primary_key=True)
+    high_water_mark = Column(Integer, nullable=False, default=0)
+    after_id = Column(Integer, nullable=True)  # Ultimo id_client cargado
+    completed_at = Column(DateTime, nullable=True)
+
+
+def add_missing_columns(connection):
+    """Add the nullable columns missing in existing tables (create_all only creates new tables)."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def create_missing_indexes(connection):
+    """Create the indexes missing in existing tables (create_all only creates them with new tables)."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""Tests of the delivery.check_cancel decision."""
+from app.business_logic.delivery_cancel import resolve_cancel
+from app.sql import models
+
+
+def test_created_delivery_is_canceled():
+    assert resolve_cancel(models.Delivery.STATUS_CREATED) == (models.Delivery.STATUS_CANCELED, True)
+
+
+def test_already_canceled_delivery_is_accepted_again():
+    assert resolve_cancel(models.Delivery.STATUS_CANCELED) == (None, True)
+
+
+def test_delivery_in_course_is_not_canceled():
+    assert resolve_cancel(models.Delivery.STATUS_DELIVERING) == (None, False)
+    assert resolve_cancel(models.Delivery.STATUS_DELIVERED) == (None, False)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Production telemetry of the machine.
+
+Every finished production cycle is recorded in a fixed-size ring buffer (TELEMETRY_BUFFER_SIZE
+cycles). Metrics are computed over the cycles finished in the last TELEMETRY_WINDOW_SECONDS.
+"""
+import math
+import os
+import time
+from array import array
+
+TELEMETRY_BUFFER_SIZE = int(os.getenv("TELEMETRY_BUFFER_SIZE", "1024"))
+TELEMETRY_WINDOW_SECONDS = float(os.getenv("TELEMETRY_WINDOW_SECONDS", "300"))
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+class ProductionTelemetry:
+    """Ring buffer of production cycles: end time, duration, pieces and mean queue wait."""
+
+    def __init__(self, size: int = TELEMETRY_BUFFER_SIZE, window: float = TELEMETRY_WINDOW_SECONDS):
+        self.size = size
+        self.window = window
+        self.finished_at = array('d', [0.0] * size)
+        self.cycle_seconds = array('d', [0.0] * size)
+        self.wait_seconds = array('d', [0.0] * size)
+        self.pieces = array('i', [0] * size)
+        self._next = 0
+        self._count = 0
+        self.started_at = time.monotonic()
+
+    def record_cycle(self, started, finished, pieces, wait_seconds):
+        """Add a finished cycle (monotonic times) of `pieces` pieces that waited `wait_seconds` on average."""
+        index = self._next
+        self.finished_at[index] = finished
+        self.cycle_seconds[index] = finished - started
+        self.wait_seconds[index] = wait_seconds
+        self.pieces[index] = pieces
+        self._next = (index + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def _recent(self, since):
+        for offset in range(1, self._count + 1):
+            index = (self._next - offset) % self.size
+            if self.finished_at[index] < since:
+                break
+            yield index
+
+    def summary(self, slots: int, busy_seconds_now: float = 0.0):
+        """Metrics of the window. busy_seconds_now is the time spent so far by unfinished cycles."""
+        now = time.monotonic()
+        window = min(self.window, now - self.started_at) or 1.0
+        recent = list(self._recent(now - window))
+        pieces = sum(self.pieces[index] for index in recent)
+        cycles = sorted(self.cycle_seconds[index] for index in recent)
+        busy = sum(cycles) + busy_seconds_now
+        return {
+            "window_seconds": window,
+            "cycles": len(recent),
+            "pieces": pieces,
+            "pieces_per_minute": pieces * 60.0 / window,
+            "utilisation": min(100.0, 100.0 * busy / (window * slots)),
+            "cycle_seconds_mean": sum(cycles) / len(cycles) if cycles else 0.0,
+            "cycle_seconds_p95": percentile(cycles, 0.95),
+            "queue_wait_seconds_mean": (
+                sum(self.wait_seconds[index] * self.pieces[index] for index in recent) / pieces if pieces else 0.0
+            )
+        }
@@ -13,4 +13,42 @@ class MachineStatusResponse(BaseModel):
         default=None,
         example="Machine Status: Idle"
     )
+    slots: List[dict] = Field(
+        description="State of every production slot",
+        default=[],
+        example=[{"slot": 0, "pieces": 1, "piece_ids": [12], "cycle_seconds": 1.2, "cycles": 10}]
+    )
+    current_piece_ids: List[int] = Field(
+        description="Pieces being produced right now",
+        default=[],
+        example=[12]
+    )
+    utilisation: float = Field(
+        description="Percentage of slot time spent producing in the telemetry window",
+        default=0.0,
+        example=75.0
+    )
+    pieces_per_minute: float = Field(
+        description="Throughput in the telemetry window",
+        default=0.0,
+        example=20.0
+    )
+
 
+class MachineMetricsResponse(BaseModel):
+    """machine production telemetry schema definition."""
+    window_seconds: float = Field(description="Seconds covered by the metrics", example=300.0)
+    cycles: int = Field(description="Production cycles finished in the window", example=100)
+    pieces: int = Field(description="Pieces produced in the window", example=100)
+    pieces_per_minute: float = Field(description="Throughput", example=20.0)
+    utilisation: float = Field(description="Percentage of slot time spent producing", example=75.0)
+    cycle_seconds_mean: float = Field(description="Mean cycle time", example=3.0)
+    cycle_seconds_p95: float = Field(description="95th percentile of the cycle time", example=3.1)
+    queue_wait_seconds_mean: float = Field(
+        description="Mean time a piece waits in the machine queue before its cycle starts",
+        example=0.5
+    )
+    slots: int = Field(description="Production slots of the machine", example=1)
+    busy_slots: int = Field(description="Slots producing right now", example=1)
+    queued_pieces: int = Field(description="Pieces waiting for a free slot", example=3)
+    current_piece_ids: List[int] = Field(description="Pieces being produced right now", example=[12])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Production runtime of the machine.
+
+The machine has MACHINE_SLOTS production slots working concurrently. Each slot takes up to
+MACHINE_BATCH_SIZE queued pieces per cycle, and a cycle lasts CYCLE_TIME_SECONDS_<TYPE> seconds
+for that piece type. Queued pieces are taken by priority (the AMQP priority of their request) and
+then in arrival order. The state of the slots is kept in arrays indexed by slot, and every finished
+cycle is recorded in the production telemetry.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+from array import array
+from app.sql import crud
+from app.business_logic.telemetry import ProductionTelemetry
+
+logger = logging.getLogger(__name__)
+
+MACHINE_SLOTS = max(1, int(os.getenv("MACHINE_SLOTS", "1")))
+MACHINE_BATCH_SIZE = max(1, int(os.getenv("MACHINE_BATCH_SIZE", "1")))
+DEFAULT_CYCLE_TIME_SECONDS = 3.0
+
+
+def cycle_time(piece_type):
+    """Seconds of a production cycle of a piece type."""
+    return float(os.getenv(f"CYCLE_TIME_SECONDS_{piece_type}", str(DEFAULT_CYCLE_TIME_SECONDS)))
+
+
+class MachineRuntime:
+    """Produces queued pieces in parallel slots."""
+
+    def __init__(self, piece_type, slots: int = MACHINE_SLOTS, batch_size: int = MACHINE_BATCH_SIZE):
+        self.piece_type = piece_type
+        self.cycle_time = cycle_time(piece_type)
+        self.slots = slots
+        self.batch_size = batch_size
+        # Por slot: piezas del ciclo en curso (0 = libre), inicio del ciclo y ciclos completados
+        self.slot_pieces = array('i', [0] * slots)
+        self.slot_started = array('d', [0.0] * slots)
+        self.slot_cycles = array('q', [0] * slots)
+        self.slot_piece_ids = [[] for _ in range(slots)]
+        self.telemetry = ProductionTelemetry()
+        self._queue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._workers = []
+
+    async def produce(self, piece_ids, priority: int = 0):
+        """Queue the pieces and return when all of them have been produced."""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._run_slot(slot)) for slot in range(self.slots)]
+        loop = asyncio.get_running_loop()
+        futures = []
+        for id_piece in piece_ids:
+            future = loop.create_future()
+            self._queue.put_nowait((-priority, next(self._sequence), id_piece, future, time.monotonic()))
+            futures.append(future)
+        await crud.add_pending_pieces(len(piece_ids))
+        await asyncio.gather(*futures)
+
+    async def _run_slot(self, slot):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            started = time.monotonic()
+            self.slot_pieces[slot] = len(batch)
+            self.slot_started[slot] = started
+            self.slot_piece_ids[slot] = [item[2] for item in batch]
+            await self._update_status()
+            try:
+                await asyncio.sleep(self.cycle_time)
+            finally:
+                finished = time.monotonic()
+                elapsed = finished - started
+                self.slot_pieces[slot] = 0
+                self.slot_piece_ids[slot] = []
+                self.slot_cycles[slot] += 1
+                self.telemetry.record_cycle(
+                    started, finished, len(batch),
+                    sum(started - item[4] for item in batch) / len(batch)
+                )
+            for _, _, id_piece, future, _ in batch:
+                # Tiempo efectivo por pieza con todos los slots trabajando
+                await crud.record_piece_produced(elapsed / (len(batch) * self.slots))
+                logger.info(f"Piece {self.piece_type} produced: {id_piece} (slot {slot})")
+                if not future.done():
+                    future.set_result(id_piece)
+            await self._update_status()
+
+    def busy_slots(self):
+        return sum(1 for pieces in self.slot_pieces if pieces)
+
+    async def _update_status(self):
+        if self.busy_slots():
+            await crud.set_status_of_machine("Machine Status: Producing")
+        else:
+            await crud.set_status_of_machine("Machine Status: Idle")
+
+    def slots_state(self):
+        """State of every slot."""
+        now = time.monotonic()
+        return [
+            {
+                "slot": slot,
+                "pieces": self.slot_pieces[slot],
+                "piece_ids": list(self.slot_piece_ids[slot]),
+                "cycle_seconds": now - self.slot_started[slot] if self.slot_pieces[slot] else 0.0,
+                "cycles": self.slot_cycles[slot]
+            }
+            for slot in range(self.slots)
+        ]
+
+    def current_piece_ids(self):
+        """Ids of the pieces being produced right now."""
+        return [id_piece for piece_ids in self.slot_piece_ids for id_piece in piece_ids]
+
+    def metrics(self):
+        """Telemetry of the production window plus the current work of the machine."""
+        now = time.monotonic()
+        in_progress = sum(
+            now - self.slot_started[slot] for slot in range(self.slots) if self.slot_pieces[slot]
+        )
+        return {
+            **self.telemetry.summary(self.slots, in_progress),
+            "slots": self.slots,
+            "busy_slots": self.busy_slots(),
+            "queued_pieces": self._queue.qsize(),
+            "current_piece_ids": self.current_piece_ids()
+        }
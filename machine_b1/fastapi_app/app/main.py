@@ -66,6 +66,8 @@ async def startup_event():
         register_consul_service()
 
         asyncio.create_task(rabbitmq.subscribe())
+        asyncio.create_task(rabbitmq.subscribe_machine_queue())
+        asyncio.create_task(rabbitmq.publish_machine_status_periodically())
         try:
             task = asyncio.create_task(update_system_resources_periodically(15))
         except Exception as e:
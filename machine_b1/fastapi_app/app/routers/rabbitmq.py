@@ -2,8 +2,10 @@ import asyncio
 import aio_pika
 import json
 import logging
+import os
 from app.sql import crud
 from app.routers import rabbitmq_publish_logs
+from app.business_logic.machine_runtime import MachineRuntime, MACHINE_SLOTS
 import ssl
 import logging
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
@@ -21,6 +23,19 @@ channel = None
 exchange = None
 exchange_name = 'events'
 
+MACHINE_NAME = "machine_b1"
+PIECE_TYPE = "B"
+# Debe coincidir con el de las demas maquinas del mismo tipo y con las prioridades del warehouse
+PIECE_QUEUE_MAX_PRIORITY = 9
+# RabbitMQ no deja redeclarar una cola existente con otros argumentos (406 PRECONDITION_FAILED): las
+# colas con x-max-priority tienen nombre propio y las antiguas sin prioridad se borran al arrancar
+PRIORITY_QUEUE_SUFFIX = "priority"
+LEGACY_PIECE_QUEUES = ("piece_b.requested", f"piece_b.requested.{MACHINE_NAME}")
+MACHINE_STATUS_INTERVAL_SECONDS = int(os.getenv("MACHINE_STATUS_INTERVAL_SECONDS", "5"))
+machine_runtime = MachineRuntime(PIECE_TYPE)
+# Referencias a las producciones en curso para que el event loop no las recoja antes de terminar
+production_tasks = set()
+
 async def subscribe_channel():
     """
     Conéctate a RabbitMQ utilizando SSL, declara los intercambios necesarios y configura el canal.
@@ -56,37 +71,108 @@ async def subscribe_channel():
         set_rabbitmq_status(True)
         logger.info("rabbitmq_working : " + str(rabbitmq_working))
         logger.info(f"Intercambio '{exchange_name}' declarado con éxito")
+        # Un mensaje por slot entre las dos colas (prefetch global del canal, no por consumidor):
+        # el resto espera en la cola para otras maquinas
+        await channel.set_qos(prefetch_count=MACHINE_SLOTS, global_=True)
+        # Las peticiones que quedasen en las colas antiguas las vuelve a pedir el warehouse
+        for legacy_queue in LEGACY_PIECE_QUEUES:
+            await channel.queue_delete(legacy_queue)
 
     except Exception as e:
         logger.error(f"Error durante la suscripción: {e}")
         raise  # Propaga el error para manejo en niveles superiores
 
+def _on_production_done(task):
+    production_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error in production task: {task.exception()}")
+
+
+def start_production(message):
+    """Process a piece request in background, keeping a reference to the task until it finishes."""
+    task = asyncio.create_task(on_message(message))
+    production_tasks.add(task)
+    task.add_done_callback(_on_production_done)
+
+
 async def on_message(message):
     async with message.process():
-        piece = json.loads(message.body)
-        await crud.set_status_of_machine("Machine Status: Producing")
-        await asyncio.sleep(3)
-        logger.info("Piece B produced: " + piece['id_piece'])
-        await crud.set_status_of_machine("Machine Status: Idle")
-        data = {
-            "id_piece": piece['id_piece']
-        }
-        message_body = json.dumps(data)
-        routing_key = "piece.produced"
-        await publish(message_body, routing_key)
+        try:
+            request = json.loads(message.body)
+            # Lote {"id_pieces": [...]} o pieza suelta {"id_piece": n}
+            piece_ids = request['id_pieces'] if 'id_pieces' in request else [request['id_piece']]
+            logger.debug(f"Received piece request: {piece_ids}")
+
+            await machine_runtime.produce(piece_ids, message.priority or 0)
+
+            data = {"id_pieces": piece_ids, "machine": MACHINE_NAME}
+            message_body = json.dumps(data)
+            routing_key = "piece.produced"
+
+            logger.debug(f"Publishing message: {message_body} to routing key: {routing_key}")
+            await publish(message_body, routing_key)
+            logger.debug("Message published successfully.")
+            await publish_machine_status()
+        except Exception as e:
+            logger.error(f"Error in on_message: {e}")
 
 
 async def subscribe():
     # Create queue
-    queue_name = "piece_b.requested"
-    queue = await channel.declare_queue(name=queue_name, exclusive=False)
+    queue_name = f"piece_b.requested.{PRIORITY_QUEUE_SUFFIX}"
+    queue = await channel.declare_queue(
+        name=queue_name, exclusive=False, arguments={"x-max-priority": PIECE_QUEUE_MAX_PRIORITY}
+    )
     # Bind the queue to the exchange
     routing_key = "piece_b.requested"
     await queue.bind(exchange=exchange_name, routing_key=routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_message(message)
+            # Sin esperar: los mensajes en curso los limita el prefetch (uno por slot)
+            start_production(message)
+
+
+async def subscribe_machine_queue():
+    # Cola propia: el scheduler del warehouse envia aqui las piezas asignadas a esta maquina
+    queue_name = f"piece_b.requested.{MACHINE_NAME}.{PRIORITY_QUEUE_SUFFIX}"
+    queue = await channel.declare_queue(
+        name=queue_name, exclusive=False, arguments={"x-max-priority": PIECE_QUEUE_MAX_PRIORITY}
+    )
+    # Bind the queue to the exchange
+    routing_key = f"piece_b.requested.{MACHINE_NAME}"
+    await queue.bind(exchange=exchange_name, routing_key=routing_key)
+    # Set up a message consumer
+    async with queue.iterator() as queue_iter:
+        async for message in queue_iter:
+            # Sin esperar: los mensajes en curso los limita el prefetch (uno por slot)
+            start_production(message)
+
+
+async def publish_machine_status():
+    """Publish the load and a compact telemetry summary of this machine for the warehouse scheduler."""
+    metrics = machine_runtime.metrics()
+    data = {
+        "machine": MACHINE_NAME,
+        "piece_type": PIECE_TYPE,
+        **(await crud.get_production_metrics()),
+        "utilisation": round(metrics["utilisation"], 1),
+        "pieces_per_minute": round(metrics["pieces_per_minute"], 2),
+        "cycle_seconds_p95": round(metrics["cycle_seconds_p95"], 3),
+        "queue_wait_seconds_mean": round(metrics["queue_wait_seconds_mean"], 3),
+        "busy_slots": metrics["busy_slots"],
+        "slots": metrics["slots"]
+    }
+    await publish(json.dumps(data), "machine.status")
+
+
+async def publish_machine_status_periodically(interval: int = MACHINE_STATUS_INTERVAL_SECONDS):
+    while True:
+        try:
+            await publish_machine_status()
+        except Exception as e:
+            logger.error(f"Error publishing machine status: {e}")
+        await asyncio.sleep(interval)
 
 
 async def publish(message_body, routing_key):
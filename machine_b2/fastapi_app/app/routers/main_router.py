@@ -7,6 +7,7 @@ from fastapi import APIRouter, Depends, status, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.sql import crud
 from app.sql import schemas
+from app.routers import rabbitmq
 from .router_utils import raise_and_log_error
 from global_variables.global_variables import rabbitmq_working, system_values
 from global_variables.global_variables import get_rabbitmq_status
@@ -84,5 +85,22 @@ async def machine_status(
     """Retrieve machine status"""
     logger.debug("GET '/machine_b2/status' endpoint called.")
     machine_status = await crud.get_status_of_machine()
+    metrics = rabbitmq.machine_runtime.metrics()
+    machine_status["slots"] = rabbitmq.machine_runtime.slots_state()
+    machine_status["current_piece_ids"] = metrics["current_piece_ids"]
+    machine_status["utilisation"] = metrics["utilisation"]
+    machine_status["pieces_per_minute"] = metrics["pieces_per_minute"]
     return machine_status
 
+
+@router.get(
+    "/machine_b2/metrics",
+    summary="Retrieve machine production telemetry",
+    response_model=schemas.MachineMetricsResponse,
+    tags=['Machine_B2']
+)
+async def machine_metrics():
+    """Utilisation, throughput, cycle and queue wait times of the telemetry window."""
+    logger.debug("GET '/machine_b2/metrics' endpoint called.")
+    return rabbitmq.machine_runtime.metrics()
+
@@ -18,3 +18,32 @@ async def get_status_of_machine():
     return {
         "status": machine_status
     }
+
+
+# Produccion: piezas recibidas sin fabricar, piezas fabricadas y segundos por pieza (media movil)
+pieces_pending = 0
+pieces_produced = 0
+seconds_per_piece = None
+
+
+async def add_pending_pieces(number):
+    global pieces_pending
+    pieces_pending += number
+
+
+async def record_piece_produced(seconds):
+    global pieces_pending, pieces_produced, seconds_per_piece
+    pieces_pending -= 1
+    pieces_produced += 1
+    if seconds_per_piece is None:
+        seconds_per_piece = seconds
+    else:
+        seconds_per_piece = 0.8 * seconds_per_piece + 0.2 * seconds
+
+
+async def get_production_metrics():
+    return {
+        "queue_depth": pieces_pending,
+        "pieces_produced": pieces_produced,
+        "seconds_per_piece": seconds_per_piece
+    }
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Background publishing of the compensation commands of a bulk cancelation.
+
+The orders are canceled in one transaction by crud.bulk_cancel_orders; this module then invalidates
+every canceled order and publishes their delivery.check_cancel commands in pipelined chunks and tracks the progress of each job.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from app.sql import crud, models
+from app.routers.rabbitmq import publish_command
+
+logger = logging.getLogger(__name__)
+
+BULK_CANCEL_PUBLISH_CHUNK = int(os.getenv("BULK_CANCEL_PUBLISH_CHUNK", "500"))
+BULK_CANCEL_MAX_JOBS = int(os.getenv("BULK_CANCEL_MAX_JOBS", "100"))
+
+STATUS_RUNNING = "Running"
+STATUS_FINISHED = "Finished"
+STATUS_FAILED = "Failed"
+
+
+class BulkCancelJobs:
+    """Registry of the latest bulk cancelation jobs of this replica."""
+
+    def __init__(self, max_jobs: int):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+
+    def get(self, job_id):
+        """Return the progress of a job, or None if unknown."""
+        return self._jobs.get(job_id)
+
+    def start(self, orders):
+        """Register a job for the already canceled orders and start publishing their commands."""
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": STATUS_RUNNING,
+            "matched": len(orders),
+            "published": 0,
+            "failed": 0,
+            "created_at": datetime.utcnow(),
+            "finished_at": None
+        }
+        self._jobs[job["job_id"]] = job
+        while len(self._jobs) > self.max_jobs:
+            self._jobs.popitem(last=False)
+        asyncio.create_task(self._run(job, orders))
+        return job
+
+    @staticmethod
+    async def _publish(order):
+        message_body = json.dumps({"order_id": order["id"]})
+        await publish_command(message_body, "delivery.check_cancel")
+
+    @staticmethod
+    async def _notify(orders):
+        # Todos los pedidos ya estan cancelados en la BD: se invalidan antes de publicar ningun comando
+        for start in range(0, len(orders), BULK_CANCEL_PUBLISH_CHUNK):
+            await asyncio.gather(*(
+                crud.notify_order_changed(order["id"], models.Order.STATUS_ORDER_CANCEL_DELIVERY_PENDING)
+                for order in orders[start:start + BULK_CANCEL_PUBLISH_CHUNK]
+            ))
+
+    async def _run(self, job, orders):
+        try:
+            await self._notify(orders)
+            for start in range(0, len(orders), BULK_CANCEL_PUBLISH_CHUNK):
+                chunk = orders[start:start + BULK_CANCEL_PUBLISH_CHUNK]
+                results = await asyncio.gather(
+                    *(self._publish(order) for order in chunk), return_exceptions=True
+                )
+                errors = sum(1 for result in results if isinstance(result, Exception))
+                job["published"] += len(chunk) - errors
+                job["failed"] += errors
+            job["status"] = STATUS_FINISHED if not job["failed"] else STATUS_FAILED
+        except Exception as exc:
+            logger.error(f"Error in bulk cancelation job {job['job_id']}: {exc}")
+            job["status"] = STATUS_FAILED
+        job["finished_at"] = datetime.utcnow()
+        # Los pedidos que fallen se quedan en OrderCancelDeliveryPending y los reintenta el saga scanner
+        logger.info(
+            "Bulk cancelation %s: %i published, %i failed",
+            job["job_id"], job["published"], job["failed"]
+        )
+
+
+bulk_cancel_jobs = BulkCancelJobs(BULK_CANCEL_MAX_JOBS)
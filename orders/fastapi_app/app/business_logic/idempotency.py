@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Idempotency-Key support for POST /create_order.
+
+The response of the first request is stored with a TTL in the idempotency_keys table (shared by
+every replica) and in a per-replica LRU. Retries get that response back without starting a new saga,
+and concurrent duplicates received by this replica wait for the first one instead of running.
+While the first request runs, the key is only claimed for IDEMPOTENCY_CLAIM_SECONDS (its expires_at
+is the claim lease): a retry after that, e.g. when the replica died mid-request, takes the key over.
+The response is committed in the same transaction as the order, and a key can only be reused with
+the same request body.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from app.sql import crud
+from app.sql.database import SessionLocal
+from .lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", str(24 * 3600)))
+IDEMPOTENCY_CLAIM_SECONDS = int(os.getenv("IDEMPOTENCY_CLAIM_SECONDS", "30"))
+IDEMPOTENCY_CACHE_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_CACHE_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_CACHE_MAX_BYTES = int(os.getenv("IDEMPOTENCY_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "600"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+
+class IdempotencyConflict(Exception):
+    """The key is being processed by another replica and has no response yet."""
+
+
+class IdempotencyKeyMismatch(Exception):
+    """The key was already used with a different request body."""
+
+
+def request_hash(payload: dict):
+    """SHA-256 of a request body, independent of the order of its fields."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """Runs a request at most once per (id_client, key) during the TTL."""
+
+    def __init__(self, ttl_seconds: int, claim_seconds: int, cache: LRUCache):
+        self.ttl_seconds = ttl_seconds
+        self.claim_seconds = claim_seconds
+        self._cache = cache
+        self._in_flight = {}
+        self.replays = 0
+        self.coalesced = 0
+        self.mismatches = 0
+
+    def _check_hash(self, key, stored_hash, body_hash):
+        # Claves anteriores a request_hash: no hay con que comparar
+        if stored_hash is not None and stored_hash != body_hash:
+            self.mismatches += 1
+            raise IdempotencyKeyMismatch(f"Idempotency-Key '{key}' was already used with a different request")
+
+    async def execute(self, id_client: int, key: str, body_hash: str, create):
+        """Return the stored response for the key, or await create(save_response) and store its result.
+
+        create must call save_response(db, response) in the transaction that creates the resource,
+        so the response is committed together with it. The key can only be reused with the same
+        request body (body_hash); IdempotencyKeyMismatch is raised otherwise.
+        """
+        cache_key = f"{id_client}:{key}"
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            entry = json.loads(cached)
+            if entry["expires_at"] > datetime.utcnow().timestamp():
+                self._check_hash(key, entry.get("request_hash"), body_hash)
+                self.replays += 1
+                return entry["response"]
+            self._cache.invalidate(cache_key)
+
+        in_flight = self._in_flight.get(cache_key)
+        if in_flight is not None:
+            in_flight_hash, future = in_flight
+            self._check_hash(key, in_flight_hash, body_hash)
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[cache_key] = (body_hash, future)
+        try:
+            response, expires_at = await self._execute(id_client, key, body_hash, create)
+            self._cache.put(cache_key, json.dumps({
+                "expires_at": expires_at.timestamp(),
+                "request_hash": body_hash,
+                "response": response
+            }).encode())
+            future.set_result(response)
+            return response
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # mark as retrieved when nobody else is waiting
+            raise
+        finally:
+            del self._in_flight[cache_key]
+
+    async def _execute(self, id_client, key, body_hash, create):
+        claimed_until = datetime.utcnow() + timedelta(seconds=self.claim_seconds)
+        async with SessionLocal() as db:
+            existing = await crud.reserve_idempotency_key(db, id_client, key, body_hash, claimed_until)
+        if existing is not None:
+            self._check_hash(key, existing.request_hash, body_hash)
+            if existing.response is None:
+                raise IdempotencyConflict(f"Request with Idempotency-Key '{key}' is still in progress")
+            self.replays += 1
+            return json.loads(existing.response), existing.expires_at
+        # Con la respuesta guardada la clave pasa a durar el TTL completo
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+
+        async def save_response(db, response):
+            await crud.store_idempotency_response(db, id_client, key, json.dumps(response), expires_at)
+
+        try:
+            response = await create(save_response)
+        except Exception:
+            # Solo se libera si la respuesta no llego a confirmarse con el pedido
+            async with SessionLocal() as db:
+                await crud.release_idempotency_key(db, id_client, key)
+            raise
+        return response, expires_at
+
+    def stats(self):
+        """Return replay metrics."""
+        return {
+            "in_flight": len(self._in_flight),
+            "replays": self.replays,
+            "coalesced": self.coalesced,
+            "mismatches": self.mismatches,
+            "cache": self._cache.stats()
+        }
+
+
+idempotency_store = IdempotencyStore(
+    IDEMPOTENCY_KEY_TTL_SECONDS,
+    IDEMPOTENCY_CLAIM_SECONDS,
+    LRUCache(IDEMPOTENCY_CACHE_MAX_ENTRIES, IDEMPOTENCY_CACHE_MAX_BYTES)
+)
+
+
+async def purge_expired_keys_periodically(interval: int = IDEMPOTENCY_PURGE_INTERVAL_SECONDS):
+    """Delete expired idempotency keys from the database every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with SessionLocal() as db:
+                deleted = await crud.purge_expired_idempotency_keys(db)
+            if deleted:
+                logger.info("Purged %i expired idempotency keys", deleted)
+        except Exception as exc:
+            logger.error(f"Error purging idempotency keys: {exc}")
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Bounded in-memory LRU cache for serialised responses."""
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache of bytes values, bounded by entry count and total size."""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        # Incremented on every invalidation, so a value read from the database before an
+        # invalidation is not stored after it (see put()).
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return the cached value for key (or None) and mark it as recently used."""
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value: bytes, epoch: int = None):
+        """Store value for key. It is discarded if an invalidation happened since `epoch`."""
+        if epoch is not None and epoch != self.epoch:
+            return
+        if len(value) > self.max_bytes:
+            return
+        self._discard(key)
+        self._items[key] = value
+        self._bytes += len(value)
+        while len(self._items) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove key from the cache."""
+        self.epoch += 1
+        if self._discard(key):
+            self.invalidations += 1
+
+    def clear(self):
+        """Remove every entry."""
+        self.epoch += 1
+        self._items.clear()
+        self._bytes = 0
+
+    def stats(self):
+        """Return cache usage metrics."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._items),
+            "max_entries": self.max_entries,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+    def _discard(self, key):
+        value = self._items.pop(key, None)
+        if value is None:
+            return False
+        self._bytes -= len(value)
+        return True
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Per-replica cache of serialised GET /order/retrieve/{order_id} responses."""
+import os
+import uuid
+from .lru_cache import LRUCache
+
+ORDER_CACHE_MAX_ENTRIES = int(os.getenv("ORDER_CACHE_MAX_ENTRIES", "10000"))
+ORDER_CACHE_MAX_BYTES = int(os.getenv("ORDER_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# Identifies this replica in the invalidation broadcast, so it can skip its own messages.
+REPLICA_ID = uuid.uuid4().hex
+
+order_cache = LRUCache(ORDER_CACHE_MAX_ENTRIES, ORDER_CACHE_MAX_BYTES)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""In-process pub/sub of order status changes, keyed by order id."""
+import asyncio
+import bisect
+import os
+import time
+from collections import OrderedDict, deque
+
+ORDER_EVENTS_HISTORY = int(os.getenv("ORDER_EVENTS_HISTORY", "16"))
+ORDER_EVENTS_TRACKED_ORDERS = int(os.getenv("ORDER_EVENTS_TRACKED_ORDERS", "10000"))
+ORDER_EVENTS_QUEUE_SIZE = 64
+
+
+class OrderEventBroker:
+    """Fan out status changes to the listeners of each order.
+
+    Event ids are the epoch milliseconds given by the replica where the change happened and are
+    broadcast with the cache invalidation, so every replica knows an event by the same id and a
+    client can resume from its Last-Event-ID on any of them. The last events of the most recently
+    updated orders are kept for that; an id not in them gets the current status instead.
+    """
+
+    def __init__(self, history_size: int, tracked_orders: int):
+        self.history_size = history_size
+        self.tracked_orders = tracked_orders
+        self._subscribers = {}
+        self._history = OrderedDict()
+        self._last_id = {}
+
+    def subscribe(self, order_id):
+        """Register a listener and return the queue its events will be put on."""
+        queue = asyncio.Queue(maxsize=ORDER_EVENTS_QUEUE_SIZE)
+        self._subscribers.setdefault(order_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, order_id, queue):
+        """Remove a listener."""
+        listeners = self._subscribers.get(order_id)
+        if listeners is None:
+            return
+        listeners.discard(queue)
+        if not listeners:
+            del self._subscribers[order_id]
+
+    def publish(self, order_id, status, event_id=None):
+        """Record a status change and deliver it to the listeners of the order. Returns its event id.
+
+        event_id is given for the changes received from other replicas and generated otherwise.
+        """
+        last_id = self._last_id.get(order_id, 0)
+        if event_id is None:
+            # Nunca por debajo del ultimo evento conocido, aunque el reloj vaya por detras
+            event_id = max(int(time.time() * 1000), last_id + 1)
+        history = self._history.pop(order_id, None)
+        if history is None:
+            history = deque(maxlen=self.history_size)
+        self._history[order_id] = history
+        if (event_id, status) in history:
+            return event_id
+        if event_id > last_id:
+            history.append((event_id, status))
+            self._last_id[order_id] = event_id
+        else:
+            # Llega tarde de otra replica: se guarda en orden
+            events = list(history)
+            bisect.insort(events, (event_id, status))
+            history.clear()
+            history.extend(events[-self.history_size:])
+        while len(self._history) > self.tracked_orders:
+            evicted, _ = self._history.popitem(last=False)
+            if evicted not in self._subscribers:
+                self._last_id.pop(evicted, None)
+        for queue in self._subscribers.get(order_id, ()):
+            if queue.full():
+                queue.get_nowait()  # Slow listener: drop its oldest event
+            queue.put_nowait((event_id, status))
+        return event_id
+
+    def last_event_id(self, order_id):
+        """Return the id of the last event published for the order (0 if none)."""
+        return self._last_id.get(order_id, 0)
+
+    def events_after(self, order_id, last_event_id):
+        """Return the events newer than last_event_id, or None if last_event_id is not known here."""
+        history = self._history.get(order_id)
+        if last_event_id is None or not history:
+            return None
+        if not any(event_id == last_event_id for event_id, _ in history):
+            return None
+        return [event for event in history if event[0] > last_event_id]
+
+    def listener_count(self):
+        """Return the number of connected listeners."""
+        return sum(len(listeners) for listeners in self._subscribers.values())
+
+
+order_events = OrderEventBroker(ORDER_EVENTS_HISTORY, ORDER_EVENTS_TRACKED_ORDERS)
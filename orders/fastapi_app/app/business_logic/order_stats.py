@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Periodic reconciliation of the order status counters with the orders table."""
+import asyncio
+import logging
+import os
+from app.sql import crud
+from app.sql.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+ORDER_STATS_RECONCILE_INTERVAL_SECONDS = int(os.getenv("ORDER_STATS_RECONCILE_INTERVAL_SECONDS", "3600"))
+
+
+async def reconcile_status_counters():
+    """Recompute the counters with a GROUP BY over the orders table."""
+    async with SessionLocal() as db:
+        await crud.reconcile_status_counters(db)
+    logger.info("Order status counters reconciled")
+
+
+async def reconcile_status_counters_periodically(interval: int = ORDER_STATS_RECONCILE_INTERVAL_SECONDS):
+    """Reconcile the counters now and then every `interval` seconds."""
+    while True:
+        try:
+            await reconcile_status_counters()
+        except Exception as exc:
+            logger.error(f"Error reconciling order status counters: {exc}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Background scanner for sagas stuck waiting for a response that was lost.
+
+Every SAGA_SCAN_INTERVAL_SECONDS the orders that have been in a pending saga status for longer than
+its deadline are claimed in batches (see crud.claim_stuck_orders) and their pending command is
+published again. Only commands that the other services handle idempotently are re-emitted; payment
+steps move money, so orders stuck in them are only counted and logged for manual review.
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from app.sql import crud, models
+from app.sql.database import SessionLocal
+from app.routers.rabbitmq import publish_command
+
+logger = logging.getLogger(__name__)
+
+SAGA_SCAN_INTERVAL_SECONDS = int(os.getenv("SAGA_SCAN_INTERVAL_SECONDS", "30"))
+SAGA_SCAN_BATCH_SIZE = int(os.getenv("SAGA_SCAN_BATCH_SIZE", "200"))
+# Maximo de lotes por estado y pasada, para que una pasada tenga un coste acotado
+SAGA_SCAN_MAX_BATCHES = int(os.getenv("SAGA_SCAN_MAX_BATCHES", "10"))
+SAGA_DEFAULT_DEADLINE_SECONDS = int(os.getenv("SAGA_DEFAULT_DEADLINE_SECONDS", "120"))
+
+
+def _deadline(status):
+    """Seconds an order may stay in status, from SAGA_DEADLINE_<STATUS> or the default."""
+    return int(os.getenv(f"SAGA_DEADLINE_{status.upper()}", str(SAGA_DEFAULT_DEADLINE_SECONDS)))
+
+
+def _order_id_client(order):
+    return {"id_order": order["id"], "id_client": order["id_client"]}
+
+
+def _order_id(order):
+    return {"order_id": order["id"]}
+
+
+def _order_id_and_client(order):
+    return {"order_id": order["id"], "id_client": order["id_client"]}
+
+
+# status -> (routing key of the pending command, message builder)
+RETRY_COMMANDS = {
+    models.Order.STATUS_DELIVERY_PENDING: ("delivery.check", _order_id_client),
+    models.Order.STATUS_DELIVERY_CANCELING: ("delivery.cancel", _order_id_and_client),
+    models.Order.STATUS_ORDER_CANCEL_DELIVERY_PENDING: ("delivery.check_cancel", _order_id),
+    models.Order.STATUS_ORDER_CANCEL_WAREHOUSE_PENDING: ("warehouse.check_cancel", _order_id_and_client),
+    models.Order.STATUS_ORDER_CANCEL_DELIVERY_REDELIVERING: ("delivery.revert_cancel", _order_id),
+}
+
+# Not retried: payment.check, payment.check_cancel and payment.revert_cancel are not idempotent
+REPORT_ONLY = (
+    models.Order.STATUS_PAYMENT_PENDING,
+    models.Order.STATUS_ORDER_CANCEL_PAYMENT_PENDING,
+    models.Order.STATUS_ORDER_CANCEL_PAYMENT_RECHARGING,
+)
+
+SAGA_DEADLINES = {status: _deadline(status) for status in (*RETRY_COMMANDS, *REPORT_ONLY)}
+
+
+class SagaScanner:
+    """Re-emits the pending command of stuck sagas and keeps per-status metrics."""
+
+    def __init__(self):
+        self.stuck = {status: 0 for status in SAGA_DEADLINES}
+        self.retried = {status: 0 for status in RETRY_COMMANDS}
+        self.scans = 0
+        self.last_scan = None
+
+    async def scan(self):
+        """Run one pass over every pending saga status."""
+        now = datetime.utcnow()
+        async with SessionLocal() as db:
+            for status, deadline in SAGA_DEADLINES.items():
+                older_than = now - timedelta(seconds=deadline)
+                self.stuck[status] = await crud.count_stuck_orders(db, status, older_than)
+                if status in RETRY_COMMANDS and self.stuck[status]:
+                    await self._retry(db, status, older_than)
+                elif self.stuck[status]:
+                    logger.warning("%i orders stuck in %s need manual review", self.stuck[status], status)
+        self.scans += 1
+        self.last_scan = now
+
+    async def _retry(self, db, status, older_than):
+        routing_key, build_message = RETRY_COMMANDS[status]
+        for _ in range(SAGA_SCAN_MAX_BATCHES):
+            orders = await crud.claim_stuck_orders(db, status, older_than, SAGA_SCAN_BATCH_SIZE)
+            await asyncio.gather(*(
+                publish_command(json.dumps(build_message(order)), routing_key) for order in orders
+            ))
+            self.retried[status] += len(orders)
+            if orders:
+                logger.info("Re-emitted %s for %i orders stuck in %s", routing_key, len(orders), status)
+            if len(orders) < SAGA_SCAN_BATCH_SIZE:
+                break
+
+    def stats(self):
+        """Return stuck counts per status as of the last scan, and retry counters."""
+        return {
+            "stuck": self.stuck,
+            "retried": self.retried,
+            "deadlines": SAGA_DEADLINES,
+            "scans": self.scans,
+            "last_scan": self.last_scan.isoformat() if self.last_scan else None
+        }
+
+
+saga_scanner = SagaScanner()
+
+
+async def scan_stuck_sagas_periodically(interval: int = SAGA_SCAN_INTERVAL_SECONDS):
+    """Run the saga scanner every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await saga_scanner.scan()
+        except Exception as exc:
+            logger.error(f"Error scanning stuck sagas: {exc}")
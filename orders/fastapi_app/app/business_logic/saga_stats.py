@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Latency of each saga transition, computed from the sagas history table.
+
+The history is read as three columns (order id, status, timestamp) sorted by order and the latencies
+are computed with NumPy over the whole extract. It can also be run offline:
+
+    python -m app.business_logic.saga_stats --hours 24
+"""
+import argparse
+import asyncio
+import json
+from datetime import datetime, timedelta
+import numpy as np
+from app.sql import crud
+from app.sql.database import SessionLocal
+
+PERCENTILES = (50, 95, 99)
+SECONDS_PER_DAY = 86400.0
+
+
+def transition_latencies(order_ids, statuses, timestamps):
+    """Latency distribution of every (from status, to status) pair.
+
+    The three arrays are the saga rows sorted by order id and then by time; timestamps in seconds.
+    """
+    order_ids = np.asarray(order_ids, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if order_ids.size < 2:
+        return []
+    status_names, codes = np.unique(np.asarray(statuses, dtype=object).astype(str), return_inverse=True)
+
+    # Consecutive rows of the same order are one transition
+    same_order = order_ids[1:] == order_ids[:-1]
+    from_codes = codes[:-1][same_order]
+    to_codes = codes[1:][same_order]
+    latencies = np.diff(timestamps)[same_order]
+    if latencies.size == 0:
+        return []
+
+    pairs = from_codes * len(status_names) + to_codes
+    order = np.argsort(pairs, kind="stable")
+    pairs, latencies = pairs[order], latencies[order]
+    unique_pairs, starts, counts = np.unique(pairs, return_index=True, return_counts=True)
+
+    stats = []
+    for pair, start, count in zip(unique_pairs, starts, counts):
+        group = latencies[start:start + count]
+        values = np.percentile(group, PERCENTILES)
+        stats.append({
+            "from_status": str(status_names[pair // len(status_names)]),
+            "to_status": str(status_names[pair % len(status_names)]),
+            "count": int(count),
+            "mean": float(group.mean()),
+            **{f"p{p}": float(v) for p, v in zip(PERCENTILES, values)}
+        })
+    stats.sort(key=lambda item: item["count"], reverse=True)
+    return stats
+
+
+async def compute_saga_stats(db, since: datetime, until: datetime):
+    """Transition latencies of the saga rows created between since and until."""
+    order_ids, statuses, julian_days = await crud.get_sagas_history_columns(db, since, until)
+    timestamps = np.asarray(julian_days, dtype=np.float64) * SECONDS_PER_DAY
+    return {
+        "since": since,
+        "until": until,
+        "orders": int(np.unique(np.asarray(order_ids, dtype=np.int64)).size),
+        "transitions": transition_latencies(order_ids, statuses, timestamps)
+    }
+
+
+async def _main(hours: float):
+    until = datetime.utcnow()
+    since = until - timedelta(hours=hours)
+    async with SessionLocal() as db:
+        stats = await compute_saga_stats(db, since, until)
+    print(json.dumps(stats, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Saga transition latencies (seconds).")
+    parser.add_argument("--hours", type=float, default=24, help="Time window, ending now.")
+    args = parser.parse_args()
+    asyncio.run(_main(args.hours))
@@ -12,6 +12,9 @@ from fastapi import FastAPI
 from app.routers import main_router, rabbitmq, rabbitmq_publish_logs
 from app.sql import models
 from app.sql import database, crud
+from app.business_logic.idempotency import purge_expired_keys_periodically
+from app.business_logic.saga_scanner import scan_stuck_sagas_periodically
+from app.business_logic.order_stats import reconcile_status_counters_periodically
 import global_variables
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 # Configure logging ################################################################################
@@ -64,6 +67,8 @@ async def startup_event():
         logger.info("Creating database tables")
         async with database.engine.begin() as conn:
             await conn.run_sync(models.Base.metadata.create_all)
+            await conn.run_sync(models.add_missing_columns)
+            await conn.run_sync(models.create_missing_indexes)
         db = database.SessionLocal()
         _ = await crud.create_catalog_from_schema(db)
         await db.close()
@@ -84,6 +89,10 @@ async def startup_event():
         asyncio.create_task(rabbitmq.subscribe_payment_checked_order_cancel())
         asyncio.create_task(rabbitmq.subscribe_command_payment_checked())
         asyncio.create_task(rabbitmq.subscribe_delivery_checked())
+        asyncio.create_task(rabbitmq.subscribe_cache_invalidation())
+        asyncio.create_task(purge_expired_keys_periodically())
+        asyncio.create_task(scan_stuck_sagas_periodically())
+        asyncio.create_task(reconcile_status_counters_periodically())
         asyncio.create_task(update_system_resources_periodically(15))
 
         data = {
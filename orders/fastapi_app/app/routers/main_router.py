@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 """FastAPI router definitions."""
+import asyncio
 import logging
 import json
+import os
 import httpx
 import requests
-from typing import List
-from fastapi import APIRouter, Depends, status, HTTPException
+from typing import List, Optional
+from datetime import datetime, timedelta
+from fastapi import APIRouter, Depends, status, HTTPException, Query, Header, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer, OAuth2PasswordBearer
 from jose import JWTError, jwt
 from pydantic.json_schema import models_json_schema
@@ -18,7 +21,16 @@ from .router_utils import raise_and_log_error
 from typing import Dict
 from global_variables.global_variables import rabbitmq_working, system_values
 from global_variables.global_variables import get_rabbitmq_status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from app.business_logic.order_cache import order_cache
+from app.business_logic.order_events import order_events
+from app.business_logic.idempotency import (
+    idempotency_store, request_hash, IdempotencyKeyMismatch, IDEMPOTENCY_KEY_MAX_LENGTH
+)
+from app.business_logic.saga_scanner import saga_scanner
+from app.business_logic.bulk_cancel import bulk_cancel_jobs
+from app.business_logic.saga_stats import compute_saga_stats
+from app.sql.database import SessionLocal
 
 with open("/keys/priv.pem", "r") as priv_file:
     PRIVATE_KEY = priv_file.read()
@@ -30,6 +42,10 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+ORDER_PAGE_MAX_LIMIT = 500
+ORDER_EVENTS_HEARTBEAT_SECONDS = float(os.getenv("ORDER_EVENTS_HEARTBEAT_SECONDS", "15"))
+ORDER_FINAL_STATUSES = (models.Order.STATUS_DELIVERED, models.Order.STATUS_CANCELED)
+
 # Claves de JWT y configuración
 
 
@@ -198,15 +214,40 @@ async def health_check():
 )
 async def create_order(
     order_schema: schemas.OrderPost,
+    idempotency_key: Optional[str] = Header(
+        None, alias="Idempotency-Key", min_length=1, max_length=IDEMPOTENCY_KEY_MAX_LENGTH
+    ),
     current_user: dict = Depends(get_current_user),
     db: AsyncSession = Depends(dependencies.get_db),
 
 ):
-    """Create single order endpoint."""
+    """Create single order endpoint.
+
+    Requests repeated with the same Idempotency-Key return the first response without creating
+    a new order.
+    """
     logger.debug("POST '/order' endpoint called.")
     try:
         order_schema.id_client = current_user["id_client"]
-        db_order = await crud.create_order_from_schema(db, order_schema)
+
+        def order_created(db_order):
+            return {"detail": "Order created successfully", "order_id": db_order.id}
+
+        async def create(save_response=None):
+            async def on_created(order_db, db_order):
+                await save_response(order_db, order_created(db_order))
+
+            db_order = await crud.create_order_from_schema(
+                db, order_schema, on_created if save_response is not None else None
+            )
+            return order_created(db_order)
+
+        if idempotency_key is None:
+            response = await create()
+        else:
+            response = await idempotency_store.execute(
+                current_user["id_client"], idempotency_key, request_hash(order_schema.model_dump(mode="json")), create
+            )
         data = {
             "message": "INFO - Order created"
         }
@@ -215,7 +256,15 @@ async def create_order(
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
 
         # Retornar la respuesta final
-        return {"detail": "Order created successfully", "order_id": db_order.id}
+        return response
+    except IdempotencyKeyMismatch as exc:
+        data = {
+            "message": "ERROR - Idempotency-Key reused with a different order"
+        }
+        message_body = json.dumps(data)
+        routing_key = "orders.create_order.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise_and_log_error(logger, status.HTTP_422_UNPROCESSABLE_ENTITY, str(exc))
     except Exception as exc:
         data = {
             "message": "ERROR - Error creating order"
@@ -246,22 +295,318 @@ async def get_single_order(
 ):
     """Retrieve single order by id"""
     logger.debug("GET '/order/%i' endpoint called.", order_id)
-    order = await crud.get_order(db, order_id)
+    body = order_cache.get(order_id)
+    if body is None:
+        epoch = order_cache.epoch
+        order = await crud.get_order(db, order_id)
+        if not order:
+            data = {
+                "message": "ERROR - Order not found"
+            }
+            message_body = json.dumps(data)
+            routing_key = "orders.get_single_order.error"
+            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+            raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Order {order_id} not found")
+        body = schemas.Order.model_validate(order).model_dump_json().encode()
+        order_cache.put(order_id, body, epoch)
     data = {
         "message": "INFO - Order obtained by id"
     }
     message_body = json.dumps(data)
     routing_key = "orders.get_single_order.info"
     await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-    if not order:
-        raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Order {order_id} not found")
-        data = {
-            "message": "ERROR - Order not found"
+    return Response(content=body, media_type="application/json")
+
+
+@router.get(
+    "/order/cache/metrics",
+    summary="Retrieve order cache metrics",
+    tags=['Order']
+)
+async def get_order_cache_metrics(
+        current_user: Dict = Depends(get_current_user)
+):
+    """Hit rate and size of this replica's order cache."""
+    logger.debug("GET '/order/cache/metrics' endpoint called.")
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see cache metrics."
+        )
+    return order_cache.stats()
+
+
+@router.get(
+    "/order/idempotency/metrics",
+    summary="Retrieve idempotency key metrics",
+    tags=['Order']
+)
+async def get_idempotency_metrics(
+        current_user: Dict = Depends(get_current_user)
+):
+    """Replayed and coalesced requests and in-flight keys of this replica."""
+    logger.debug("GET '/order/idempotency/metrics' endpoint called.")
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see idempotency metrics."
+        )
+    return idempotency_store.stats()
+
+
+@router.get(
+    "/order/saga-stats",
+    summary="Saga transition latencies",
+    response_model=schemas.SagaStats,
+    tags=['Order']
+)
+async def get_saga_stats(
+        since: Optional[datetime] = Query(None, description="Start of the window (UTC). Default: 24 hours ago."),
+        until: Optional[datetime] = Query(None, description="End of the window (UTC). Default: now."),
+        db: AsyncSession = Depends(dependencies.get_db),
+        current_user: Dict = Depends(get_current_user)
+):
+    """p50/p95/p99 latency of each saga transition in the window."""
+    logger.debug("GET '/order/saga-stats' endpoint called.")
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see saga stats."
+        )
+    until = until or datetime.utcnow()
+    since = since or until - timedelta(hours=24)
+    stats = await compute_saga_stats(db, since, until)
+    data = {
+        "message": "INFO - Saga stats obtained"
+    }
+    message_body = json.dumps(data)
+    routing_key = "orders.get_saga_stats.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return stats
+
+
+@router.get(
+    "/order/saga/stuck",
+    summary="Retrieve stuck saga metrics",
+    tags=['Order']
+)
+async def get_stuck_sagas(
+        current_user: Dict = Depends(get_current_user)
+):
+    """Orders past their saga deadline per status, and how many commands were re-emitted."""
+    logger.debug("GET '/order/saga/stuck' endpoint called.")
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see saga metrics."
+        )
+    return saga_scanner.stats()
+
+
+@router.get(
+    "/orders/stats",
+    summary="Number of orders per status",
+    response_model=schemas.OrderStats,
+    tags=['Order']
+)
+async def get_order_stats(
+        client: Optional[int] = Query(None, description="Client identifier. Admins get every client by default."),
+        db: AsyncSession = Depends(dependencies.get_db),
+        current_user: Dict = Depends(get_current_user)
+):
+    """Orders per status from the counters, without reading the orders themselves."""
+    logger.debug("GET '/orders/stats' endpoint called.")
+    if current_user["role"] != "admin":
+        if client is not None and client != current_user["id_client"]:
+            data = {
+                "message": "ERROR - Access forbidden to order stats of other clients"
+            }
+            message_body = json.dumps(data)
+            routing_key = "orders.get_order_stats.error"
+            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access forbidden: you can only see your own order stats."
+            )
+        client = current_user["id_client"]
+    if client is None:
+        by_status = await crud.get_status_counters(db)
+    else:
+        by_status = await crud.get_status_counters(db, client)
+    data = {
+        "message": "INFO - Order stats obtained"
+    }
+    message_body = json.dumps(data)
+    routing_key = "orders.get_order_stats.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return {"id_client": client, "total": sum(by_status.values()), "by_status": by_status}
+
+
+@router.get(
+    "/orders",
+    summary="List orders (keyset paginated)",
+    response_model=schemas.OrderPage,
+    responses={
+        status.HTTP_403_FORBIDDEN: {
+            "model": schemas.Message, "description": "Access forbidden"
         }
-        message_body = json.dumps(data)
-        routing_key = "orders.get_single_order.error"
-        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-    return order
+    },
+    tags=["Order"]
+)
+async def list_orders(
+        client: Optional[int] = Query(None, description="Filter by client id"),
+        order_status: Optional[str] = Query(None, alias="status", description="Filter by order status"),
+        after_id: Optional[int] = Query(None, description="Return orders with id greater than this one"),
+        limit: int = Query(50, ge=1, le=ORDER_PAGE_MAX_LIMIT, description="Page size"),
+        db: AsyncSession = Depends(dependencies.get_db),
+        current_user: Dict = Depends(get_current_user)
+):
+    """List orders filtered by client and/or status. Non admin users only see their own orders."""
+    logger.debug("GET '/orders' endpoint called.")
+    if current_user["role"] != "admin":
+        if client is not None and client != current_user["id_client"]:
+            data = {
+                "message": "ERROR - You don't have permissions"
+            }
+            message_body = json.dumps(data)
+            routing_key = "orders.list_orders.error"
+            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access forbidden: you can only list your own orders."
+            )
+        client = current_user["id_client"]
+
+    rows = await crud.get_order_page(db, client, order_status, after_id, limit)
+    next_after_id = rows[-1]["id"] if len(rows) == limit else None
+    data = {
+        "message": "INFO - Order page obtained"
+    }
+    message_body = json.dumps(data)
+    routing_key = "orders.list_orders.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return {"items": rows, "next_after_id": next_after_id}
+
+
+async def order_event_stream(order_id: int, current_user: Dict, last_event_id=None):
+    """Yield (event_id, status) tuples for an order, or None when a heartbeat is due.
+
+    The stream starts with the missed events if last_event_id can be resumed, or with the
+    current status otherwise, and ends when the order reaches a final status.
+    """
+    queue = order_events.subscribe(order_id)
+    try:
+        async with SessionLocal() as db:
+            order = await crud.get_order(db, order_id)
+        if not order:
+            raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Order {order_id} not found")
+        if current_user["role"] != "admin" and order.id_client != current_user["id_client"]:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access forbidden: you can only follow your own orders."
+            )
+        pending = order_events.events_after(order_id, last_event_id)
+        if pending is None:
+            pending = [(order_events.last_event_id(order_id), order.status)]
+        for event in pending:
+            yield event
+            if event[1] in ORDER_FINAL_STATUSES:
+                return
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), ORDER_EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            yield event
+            if event[1] in ORDER_FINAL_STATUSES:
+                return
+    finally:
+        order_events.unsubscribe(order_id, queue)
+
+
+@router.get(
+    "/order/{order_id}/events",
+    summary="Follow the status of an order (Server-Sent Events)",
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"text/event-stream": {}},
+            "description": "Stream of 'status' events."
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "model": schemas.Message, "description": "Order not found"
+        }
+    },
+    tags=['Order']
+)
+async def get_order_events(
+        order_id: int,
+        last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+        current_user: Dict = Depends(get_current_user)
+):
+    """Push every status change of the order until it is delivered or canceled."""
+    logger.debug("GET '/order/%i/events' endpoint called.", order_id)
+    resume_from = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    events = order_event_stream(order_id, current_user, resume_from)
+    # Get the first event now so 404/403 are returned before the stream starts
+    first_event = await events.__anext__()
+
+    async def sse():
+        event = first_event
+        try:
+            while True:
+                if event is None:
+                    yield ": heartbeat\n\n"
+                else:
+                    data = json.dumps({"order_id": order_id, "status": event[1]})
+                    yield f"id: {event[0]}\nevent: status\ndata: {data}\n\n"
+                event = await events.__anext__()
+        except StopAsyncIteration:
+            pass
+        finally:
+            await events.aclose()
+
+    data = {
+        "message": "INFO - Order events stream opened"
+    }
+    message_body = json.dumps(data)
+    routing_key = "orders.get_order_events.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return StreamingResponse(
+        sse(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.websocket("/order/{order_id}/ws")
+async def order_events_websocket(
+        websocket: WebSocket,
+        order_id: int,
+        token: Optional[str] = None,
+        last_event_id: Optional[int] = None
+):
+    """WebSocket alternative to the SSE stream. The JWT is passed in the `token` query param."""
+    try:
+        current_user = await verify_access_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    events = order_event_stream(order_id, current_user, last_event_id)
+    try:
+        async for event in events:
+            if event is None:
+                await websocket.send_json({"type": "heartbeat"})
+            else:
+                await websocket.send_json({"type": "status", "id": event[0], "order_id": order_id, "status": event[1]})
+        await websocket.close()
+    except HTTPException as exc:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=str(exc.detail))
+    except WebSocketDisconnect:
+        logger.debug("WebSocket of order %i disconnected.", order_id)
+    finally:
+        await events.aclose()
 
 
 @router.post(
@@ -316,6 +661,82 @@ async def cancel_order(
 
 
 
+@router.post(
+    "/orders/cancel",
+    response_model=schemas.BulkCancelJob,
+    summary="Cancel every Queued order matching a filter",
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Order"]
+)
+async def bulk_cancel_orders(
+        order_filter: schemas.OrderBulkCancel,
+        db: AsyncSession = Depends(dependencies.get_db),
+        current_user: Dict = Depends(get_current_user)
+):
+    """Cancel the matching orders in one transaction and publish their compensation in background."""
+    logger.debug("POST '/orders/cancel' endpoint called.")
+    if current_user["role"] != "admin":
+        data = {"message": "ERROR - Bulk cancelation forbidden"}
+        message_body = json.dumps(data)
+        routing_key = "orders.bulk_cancel_orders.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can cancel orders in bulk."
+        )
+    if not order_filter.model_dump(exclude_none=True):
+        raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, "At least one filter field is required.")
+    order_status = order_filter.status or models.Order.STATUS_QUEUED
+    if order_status not in models.Order.BULK_CANCELABLE_STATUSES:
+        raise_and_log_error(
+            logger, status.HTTP_400_BAD_REQUEST,
+            f"Orders in status '{order_status}' can't be canceled in bulk, "
+            f"only {', '.join(models.Order.BULK_CANCELABLE_STATUSES)}."
+        )
+    orders = await crud.bulk_cancel_orders(
+        db,
+        ids=order_filter.ids,
+        id_client=order_filter.id_client,
+        status=order_status,
+        created_from=order_filter.created_from,
+        created_to=order_filter.created_to
+    )
+    job = bulk_cancel_jobs.start(orders)
+    data = {"message": f"INFO - Bulk cancelation of {len(orders)} orders started"}
+    message_body = json.dumps(data)
+    routing_key = "orders.bulk_cancel_orders.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return job
+
+
+@router.get(
+    "/orders/cancel/{job_id}",
+    response_model=schemas.BulkCancelJob,
+    summary="Retrieve the progress of a bulk cancelation",
+    responses={
+        status.HTTP_404_NOT_FOUND: {
+            "model": schemas.Message, "description": "Job not found"
+        }
+    },
+    tags=["Order"]
+)
+async def get_bulk_cancel_job(
+        job_id: str,
+        current_user: Dict = Depends(get_current_user)
+):
+    """Retrieve the progress of a bulk cancelation job."""
+    logger.debug("GET '/orders/cancel/%s' endpoint called.", job_id)
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see bulk cancelations."
+        )
+    job = bulk_cancel_jobs.get(job_id)
+    if job is None:
+        raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Bulk cancelation job {job_id} not found")
+    return job
+
+
 @router.put(
     "/order/update/{order_id}",
     summary="Update order",
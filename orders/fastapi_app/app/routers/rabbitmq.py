@@ -4,6 +4,8 @@ import json
 from app.sql.database import SessionLocal  # pylint: disable=import-outside-toplevel
 from app.sql import crud
 from app.sql import models, schemas
+from app.business_logic import order_cache
+from app.business_logic.order_events import order_events
 import logging
 import ssl
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
@@ -25,10 +27,13 @@ exchange_commands_name = 'commands'
 exchange_name = 'events'
 exchange_responses_name = 'responses'
 exchange_responses = None
+exchange_cache_name = 'orders_cache'
+exchange_cache = None
 
 async def subscribe_channel():
    
     global channel, exchange_commands, exchange, exchange_commands_name, exchange_name, exchange_responses_name, exchange_responses
+    global exchange_cache
 
     try:
         logger.info("Intentando suscribirse...")
@@ -71,6 +76,13 @@ async def subscribe_channel():
             durable=True
         )
         logger.info(f"Intercambio '{exchange_name}' declarado con éxito")
+
+        # Intercambio fanout para invalidar la cache de orders en todas las réplicas
+        exchange_cache = await channel.declare_exchange(
+            name=exchange_cache_name,
+            type='fanout'
+        )
+        logger.info(f"Intercambio '{exchange_cache_name}' declarado con éxito")
         rabbitmq_working=True
         set_rabbitmq_status(True)
         logger.info("rabbitmq_working : "+str(rabbitmq_working))
@@ -80,9 +92,21 @@ async def subscribe_channel():
         raise  # Propaga el error para manejo en niveles superiores
 
 
+async def is_stale_response(order_id, expected_status):
+    """True if the order already left expected_status, e.g. a second response to a re-emitted command."""
+    async with SessionLocal() as db:
+        db_order = await crud.get_order(db, order_id)
+    if db_order is not None and db_order.status != expected_status:
+        logger.info(f"Ignorando respuesta duplicada para la orden {order_id} en estado {db_order.status}")
+        return True
+    return False
+
+
 async def on_delivery_checked_order_cancel_message(message):
     async with message.process():
         delivery = json.loads(message.body)
+        if await is_stale_response(delivery['order_id'], models.Order.STATUS_ORDER_CANCEL_DELIVERY_PENDING):
+            return
         db = SessionLocal()
         db_saga = SessionLocal()
         db_catalog = SessionLocal()
@@ -122,13 +146,17 @@ async def subscribe_delivery_checked_order_cancel():
             await on_delivery_checked_order_cancel_message(message)
 
 
+def event_order_ids(event):
+    """Order ids of a delivery event: a wave {"orders": [...]} or a single order {"id_order"}."""
+    return [order['id_order'] for order in event.get('orders', [event])]
+
+
 async def on_order_delivered_message(message):
     async with message.process():
         order = json.loads(message.body.decode())
-        db = SessionLocal()
-        db_order = await crud.update_order_status(db, order['id_order'], models.Order.STATUS_DELIVERED)
+        async with SessionLocal() as db:
+            await crud.update_orders_status(db, event_order_ids(order), models.Order.STATUS_DELIVERED)
         # await rabbitmq_publish_logs.publish_log("order " + order['id_order'] + "delivered", "logs.info.order")
-        await db.close()
 
 
 async def subscribe_order_finished():
@@ -213,6 +241,8 @@ async def subscribe_delivery_reverted_order_cancel():
 async def on_warehouse_checked_order_cancel_message(message):
     async with message.process():
         warehouse = json.loads(message.body)
+        if await is_stale_response(warehouse['order_id'], models.Order.STATUS_ORDER_CANCEL_WAREHOUSE_PENDING):
+            return
         db = SessionLocal()
         db_saga = SessionLocal()
         if warehouse['status']:
@@ -281,9 +311,8 @@ async def subscribe_payment_reverted_order_cancel():
 async def on_delivering_message(message):
     async with message.process():
         delivery = json.loads(message.body)
-        db = SessionLocal()
-        db_order = await crud.update_order_status(db, delivery['id_order'], models.Order.STATUS_DELIVERING)
-        await db.close()
+        async with SessionLocal() as db:
+            await crud.update_orders_status(db, event_order_ids(delivery), models.Order.STATUS_DELIVERING)
 
 
 async def subscribe_delivering():
@@ -304,6 +333,8 @@ async def on_produced_message(message):
         order = json.loads(message.body)
         db = SessionLocal()
         db_order = await crud.update_order_status(db, order['id_order'], models.Order.STATUS_PRODUCED)
+        if db_order is not None:
+            await crud.create_sagas_history(db, order['id_order'], db_order.status)
         await db.close()
 
 
@@ -423,6 +454,9 @@ async def on_delivery_checked_message(message):
                 logger.error(f"Mensaje incompleto recibido: {delivery}")
                 return
 
+            if await is_stale_response(delivery['id_order'], models.Order.STATUS_DELIVERY_PENDING):
+                return
+
             # Lógica basada en el estado del delivery
             if delivery['status']:
                 logger.debug("Procesando estado 'true'")
@@ -502,6 +536,25 @@ async def on_message_delivery_cancel(message):
         await db_saga.close()
 
 
+async def on_cache_invalidation_message(message):
+    async with message.process():
+        invalidation = json.loads(message.body)
+        if invalidation['replica'] != order_cache.REPLICA_ID:
+            order_cache.order_cache.invalidate(invalidation['order_id'])
+            if invalidation.get('status'):
+                order_events.publish(invalidation['order_id'], invalidation['status'], invalidation.get('event_id'))
+
+
+async def subscribe_cache_invalidation():
+    # Cola exclusiva por réplica: todas reciben todas las invalidaciones
+    queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+    await queue.bind(exchange=exchange_cache_name)
+    # Set up a message consumer
+    async with queue.iterator() as queue_iter:
+        async for message in queue_iter:
+            await on_cache_invalidation_message(message)
+
+
 async def publish(message_body, routing_key):
     # Publish the message to the exchange
     await exchange.publish(
@@ -531,3 +584,18 @@ async def publish_responses(message_body, routing_key):
         ),
         routing_key=routing_key)
 
+
+async def publish_cache_invalidation(order_id, status=None, event_id=None):
+    """Tell the other replicas that an order changed (and its new status and event id, if known)."""
+    data = {
+        "order_id": order_id,
+        "status": status,
+        "event_id": event_id,
+        "replica": order_cache.REPLICA_ID
+    }
+    await exchange_cache.publish(
+        aio_pika.Message(
+            body=json.dumps(data).encode(),
+            content_type="text/plain"
+        ),
+        routing_key="")
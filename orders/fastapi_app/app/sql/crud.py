@@ -1,22 +1,30 @@
 # -*- coding: utf-8 -*-
 """Functions that interact with the database."""
+import asyncio
 import logging
 import json
 from datetime import datetime
-from sqlalchemy import or_
+from sqlalchemy import or_, func, literal
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from .database import SessionLocal
-from ..routers.rabbitmq import publish_command
+from ..routers.rabbitmq import publish_command, publish_cache_invalidation
+from ..business_logic.order_cache import order_cache
+from ..business_logic.order_events import order_events
 from . import models
-from sqlalchemy import update
+from sqlalchemy import update, delete, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 logger = logging.getLogger(__name__)
 
 
 # order functions ##################################################################################
-async def create_order_from_schema(db: AsyncSession, order):
-    """Persist a new order into the database."""
+async def create_order_from_schema(db: AsyncSession, order, on_created=None):
+    """Persist a new order into the database.
+
+    on_created(db, db_order) runs once the order has its id and before the commit, so what it writes
+    (e.g. the idempotency response) is committed atomically with the order.
+    """
     db_order = models.Order(
         number_of_pieces_a=order.number_of_pieces_a,
         number_of_pieces_b=order.number_of_pieces_b,
@@ -25,6 +33,10 @@ async def create_order_from_schema(db: AsyncSession, order):
         status=models.Order.STATUS_DELIVERY_PENDING
     )
     db.add(db_order)
+    await update_status_counters(db, {(order.id_client, models.Order.STATUS_DELIVERY_PENDING): 1})
+    if on_created is not None:
+        await db.flush()
+        await on_created(db, db_order)
     await db.commit()
     await db.refresh(db_order)
     # Aqui es cuando se hace el sagas
@@ -94,9 +106,52 @@ async def get_orders_by_client(db: AsyncSession, client_id):
     orders = await get_list_statement_result(db, stmt)
     return orders
 
+async def get_order_page(db: AsyncSession, id_client=None, status=None, after_id=None, limit=50):
+    """Load a page of orders as lightweight rows using keyset pagination on the order id.
+
+    Filters by client and/or status are served by the (id_client, id) and (status, id) indexes,
+    so the cost of a page does not depend on the size of the table.
+    """
+    stmt = select(
+        models.Order.id,
+        models.Order.id_client,
+        models.Order.status,
+        models.Order.number_of_pieces_a,
+        models.Order.number_of_pieces_b,
+        models.Order.update_date
+    )
+    if id_client is not None:
+        stmt = stmt.where(models.Order.id_client == id_client)
+    if status is not None:
+        stmt = stmt.where(models.Order.status == status)
+    if after_id is not None:
+        stmt = stmt.where(models.Order.id > after_id)
+    stmt = stmt.order_by(models.Order.id).limit(limit)
+    result = await db.execute(stmt)
+    return result.mappings().all()
+
+
 async def delete_order(db: AsyncSession, order_id):
     """Delete order from the database."""
-    return await delete_element_by_id(db, models.Order, order_id)
+    db_order = await get_element_by_id(db, models.Order, order_id)
+    if db_order is not None:
+        await db.delete(db_order)
+        await update_status_counters(db, {(db_order.id_client, db_order.status): -1})
+        await db.commit()
+    await notify_order_changed(order_id)
+    return db_order
+
+
+async def notify_order_changed(order_id, status=None):
+    """Invalidate the cached order on every replica and push the new status to its listeners."""
+    order_cache.invalidate(order_id)
+    event_id = None
+    if status is not None:
+        event_id = order_events.publish(order_id, status)
+    try:
+        await publish_cache_invalidation(order_id, status, event_id)
+    except Exception as e:
+        logger.error(f"Error broadcasting cache invalidation of order {order_id}: {e}")
 
 
 async def cancel_order(db: AsyncSession, order_id):
@@ -114,16 +169,177 @@ async def cancel_order(db: AsyncSession, order_id):
     return db_order
 
 
+async def bulk_cancel_orders(db: AsyncSession, ids=None, id_client=None, status=models.Order.STATUS_QUEUED,
+                             created_from=None, created_to=None):
+    """Move every matching order to OrderCancelDeliveryPending in a single transaction.
+
+    status must be one of models.Order.BULK_CANCELABLE_STATUSES. Returns the canceled orders (id, id_client).
+    Their saga history is written in the same transaction.
+    """
+    stmt = update(models.Order).where(models.Order.status == status)
+    if ids is not None:
+        stmt = stmt.where(models.Order.id.in_(ids))
+    if id_client is not None:
+        stmt = stmt.where(models.Order.id_client == id_client)
+    if created_from is not None:
+        stmt = stmt.where(models.Order.creation_date >= created_from)
+    if created_to is not None:
+        stmt = stmt.where(models.Order.creation_date < created_to)
+    stmt = (
+        stmt.values(status=models.Order.STATUS_ORDER_CANCEL_DELIVERY_PENDING)
+        .returning(models.Order.id, models.Order.id_client)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    orders = result.mappings().all()
+    if orders:
+        deltas = {}
+        for order in orders:
+            deltas[(order["id_client"], status)] = deltas.get((order["id_client"], status), 0) - 1
+            deltas[(order["id_client"], models.Order.STATUS_ORDER_CANCEL_DELIVERY_PENDING)] = \
+                deltas.get((order["id_client"], models.Order.STATUS_ORDER_CANCEL_DELIVERY_PENDING), 0) + 1
+        await update_status_counters(db, deltas)
+        await db.execute(insert(models.SagasHistory), [
+            {"id_order": order["id"], "status": models.Order.STATUS_ORDER_CANCEL_DELIVERY_PENDING}
+            for order in orders
+        ])
+    await db.commit()
+    return orders
+
+
 async def update_order_status(db: AsyncSession, order_id, status):
     """Persist new order status on the database."""
     db_order = await get_element_by_id(db, models.Order, order_id)
     if db_order is not None:
+        if db_order.status != status:
+            await update_status_counters(db, {
+                (db_order.id_client, db_order.status): -1,
+                (db_order.id_client, status): 1
+            })
         db_order.status = status
         await db.commit()
         await db.refresh(db_order)
+        await notify_order_changed(order_id, status)
     return db_order
 
 
+async def update_orders_status(db: AsyncSession, order_ids, status):
+    """Move the given orders to a status with a single UPDATE, writing their saga history in the same transaction.
+
+    Orders already in that status are skipped. Returns the updated orders (id, id_client).
+    """
+    result = await db.execute(
+        select(models.Order.id, models.Order.status).where(
+            models.Order.id.in_(order_ids), models.Order.status != status
+        )
+    )
+    previous = {row.id: row.status for row in result}
+    if not previous:
+        return []
+    result = await db.execute(
+        update(models.Order)
+        .where(models.Order.id.in_(list(previous)), models.Order.status != status)
+        .values(status=status)
+        .returning(models.Order.id, models.Order.id_client)
+        .execution_options(synchronize_session=False)
+    )
+    orders = result.mappings().all()
+    deltas = {}
+    for order in orders:
+        for key, delta in (((order["id_client"], previous[order["id"]]), -1), ((order["id_client"], status), 1)):
+            deltas[key] = deltas.get(key, 0) + delta
+    await update_status_counters(db, deltas)
+    if orders:
+        await db.execute(insert(models.SagasHistory), [
+            {"id_order": order["id"], "status": status} for order in orders
+        ])
+    await db.commit()
+    await asyncio.gather(*(notify_order_changed(order["id"], status) for order in orders))
+    return orders
+
+
+async def claim_stuck_orders(db: AsyncSession, status, older_than: datetime, limit: int):
+    """Touch up to `limit` orders in `status` not updated since `older_than` and return them.
+
+    Touching update_date claims them: other replicas scanning at the same time will not see them
+    until the deadline passes again.
+    """
+    stuck_ids = (
+        select(models.Order.id)
+        .where(models.Order.status == status, models.Order.update_date < older_than)
+        .order_by(models.Order.update_date)
+        .limit(limit)
+    )
+    stmt = (
+        update(models.Order)
+        .where(models.Order.id.in_(stuck_ids.scalar_subquery()), models.Order.status == status)
+        .values(update_date=func.now())
+        .returning(models.Order.id, models.Order.id_client)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    orders = result.mappings().all()
+    await db.commit()
+    return orders
+
+
+async def count_stuck_orders(db: AsyncSession, status, older_than: datetime):
+    """Count orders in `status` not updated since `older_than`."""
+    stmt = select(func.count()).select_from(models.Order).where(
+        models.Order.status == status, models.Order.update_date < older_than
+    )
+    result = await db.execute(stmt)
+    return result.scalar_one()
+
+
+# Order status counters ############################################################################
+async def update_status_counters(db: AsyncSession, deltas: dict):
+    """Add {(id_client, status): delta} to the per-client and global counters. Does not commit."""
+    rows = {}
+    for (id_client, status), delta in deltas.items():
+        for key in ((id_client, status), (models.OrderStatusCounter.GLOBAL_CLIENT, status)):
+            rows[key] = rows.get(key, 0) + delta
+    rows = [
+        {"id_client": id_client, "status": status, "count": delta}
+        for (id_client, status), delta in rows.items() if delta
+    ]
+    if not rows:
+        return
+    table = models.OrderStatusCounter.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.id_client, table.c.status],
+        set_={"count": table.c.count + stmt.excluded.count}
+    )
+    await db.execute(stmt, rows)
+
+
+async def get_status_counters(db: AsyncSession, id_client=models.OrderStatusCounter.GLOBAL_CLIENT):
+    """Return {status: count} for a client, or for every client with the default id_client."""
+    stmt = select(models.OrderStatusCounter.status, models.OrderStatusCounter.count).where(
+        models.OrderStatusCounter.id_client == id_client,
+        models.OrderStatusCounter.count != 0
+    )
+    result = await db.execute(stmt)
+    return {row.status: row.count for row in result}
+
+
+async def reconcile_status_counters(db: AsyncSession):
+    """Recompute every counter from the orders table."""
+    counters = models.OrderStatusCounter.__table__
+    per_client = select(
+        models.Order.id_client, models.Order.status, func.count()
+    ).group_by(models.Order.id_client, models.Order.status)
+    global_counts = select(
+        literal(models.OrderStatusCounter.GLOBAL_CLIENT), models.Order.status, func.count()
+    ).group_by(models.Order.status)
+    await db.execute(delete(counters))
+    columns = [counters.c.id_client, counters.c.status, counters.c.count]
+    await db.execute(insert(counters).from_select(columns, per_client))
+    await db.execute(insert(counters).from_select(columns, global_counts))
+    await db.commit()
+
+
 # Piece functions ##################################################################################
 async def get_piece_list_by_status(db: AsyncSession, status):
     """Get all pieces with a given status from the database."""
@@ -232,6 +448,9 @@ async def delete_element_by_id(db: AsyncSession, model, element_id):
 async def update_order(db: AsyncSession, order_id: int, update_data: dict):
     """Actualizar los campos de una orden específicos según el `order_id`."""
     async with db.begin():
+        old = (await db.execute(
+            select(models.Order.id_client, models.Order.status).where(models.Order.id == order_id)
+        )).first()
         stmt = (
             update(models.Order)
             .where(models.Order.id == order_id)
@@ -239,10 +458,19 @@ async def update_order(db: AsyncSession, order_id: int, update_data: dict):
             .execution_options(synchronize_session="fetch")
         )
         result = await db.execute(stmt)
+        if old is not None:
+            new_client = update_data.get("id_client", old.id_client)
+            new_status = update_data.get("status", old.status)
+            if (new_client, new_status) != (old.id_client, old.status):
+                await update_status_counters(db, {
+                    (old.id_client, old.status): -1,
+                    (new_client, new_status): 1
+                })
         await db.commit()
 
     if result.rowcount == 0:
         return None  # Orden no encontrada
+    await notify_order_changed(order_id, update_data.get("status"))
     return await get_order(db, order_id)  # Retornar la orden actualizada si se realizó el update
 
 # Sagas
@@ -285,3 +513,88 @@ async def create_sagas_history(db: AsyncSession, id_order, status):
 async def get_sagas_history(db: AsyncSession, id_order):
     """Load sagas history from the database."""
     return await get_sagas_history_by_order_id(db, id_order)
+
+
+async def get_sagas_history_columns(db: AsyncSession, since: datetime, until: datetime):
+    """Return (order ids, statuses, julian days) of the sagas rows created in the window.
+
+    Rows are sorted by order and then by creation, and returned as columns instead of ORM objects.
+    """
+    stmt = (
+        select(
+            models.SagasHistory.id_order,
+            models.SagasHistory.status,
+            func.julianday(models.SagasHistory.creation_date)
+        )
+        .where(models.SagasHistory.creation_date >= since, models.SagasHistory.creation_date < until)
+        .order_by(models.SagasHistory.id_order, models.SagasHistory.id)
+    )
+    result = await db.execute(stmt)
+    rows = result.all()
+    if not rows:
+        return [], [], []
+    order_ids, statuses, julian_days = zip(*rows)
+    return order_ids, statuses, julian_days
+
+
+# idempotency keys #################################################################################
+async def reserve_idempotency_key(
+        db: AsyncSession, id_client: int, key: str, request_hash: str, claimed_until: datetime
+):
+    """Claim an idempotency key until claimed_until. Returns None if claimed, or the existing live row otherwise."""
+    now = datetime.utcnow()
+    table = models.IdempotencyKey.__table__
+    stmt = sqlite_insert(table).values(
+        key=key, id_client=id_client, response=None, expires_at=claimed_until, request_hash=request_hash
+    )
+    # Una clave caducada que aun no se ha purgado, o un claim abandonado, se puede volver a reclamar
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.key, table.c.id_client],
+        set_={
+            "response": None,
+            "expires_at": stmt.excluded.expires_at,
+            "request_hash": stmt.excluded.request_hash
+        },
+        where=table.c.expires_at < now
+    )
+    result = await db.execute(stmt)
+    await db.commit()
+    if result.rowcount:
+        return None
+    return await db.get(models.IdempotencyKey, (key, id_client))
+
+
+async def store_idempotency_response(
+        db: AsyncSession, id_client: int, key: str, response: str, expires_at: datetime
+):
+    """Save the response produced for a claimed idempotency key and keep it until expires_at. Does not commit."""
+    await db.execute(
+        update(models.IdempotencyKey)
+        .where(models.IdempotencyKey.key == key, models.IdempotencyKey.id_client == id_client)
+        .values(response=response, expires_at=expires_at)
+    )
+
+
+async def release_idempotency_key(db: AsyncSession, id_client: int, key: str):
+    """Forget a claimed idempotency key whose request failed, so it can be retried.
+
+    A key whose response was already committed (the order exists) is kept.
+    """
+    await db.execute(
+        delete(models.IdempotencyKey)
+        .where(
+            models.IdempotencyKey.key == key,
+            models.IdempotencyKey.id_client == id_client,
+            models.IdempotencyKey.response.is_(None)
+        )
+    )
+    await db.commit()
+
+
+async def purge_expired_idempotency_keys(db: AsyncSession):
+    """Delete expired idempotency keys. Returns the number of deleted rows."""
+    result = await db.execute(
+        delete(models.IdempotencyKey).where(models.IdempotencyKey.expires_at < datetime.utcnow())
+    )
+    await db.commit()
+    return result.rowcount
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Database models definitions. Table representations as class."""
-from sqlalchemy import Column, DateTime, Integer, String, TEXT, Float, ForeignKey
+from sqlalchemy import Column, DateTime, Integer, String, TEXT, Float, ForeignKey, Index, inspect, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -49,8 +49,17 @@ class Order(BaseModel):
     STATUS_ORDER_CANCEL_WAREHOUSE_PENDING = "OrderCancelWarehousePending"
     STATUS_ORDER_CANCEL_PAYMENT_RECHARGING = "OrderCancelPaymentRecharging"
     STATUS_ORDER_CANCEL_DELIVERY_REDELIVERING = "OrderCancelDeliveryRedelivering"
+    # Solo la compensacion desde Queued (delivery.check_cancel) se puede lanzar en bloque
+    BULK_CANCELABLE_STATUSES = (STATUS_QUEUED,)
 
     __tablename__ = "manufacturing_order"
+    __table_args__ = (
+        # Keyset pagination indexes for GET /orders (filter + ORDER BY id)
+        Index("ix_manufacturing_order_id_client_id", "id_client", "id"),
+        Index("ix_manufacturing_order_status_id", "status", "id"),
+        # Saga timeout scanner (orders stuck in a status since before a deadline)
+        Index("ix_manufacturing_order_status_update_date", "status", "update_date"),
+    )
     id = Column(Integer, primary_key=True)
     number_of_pieces_a = Column(Integer, nullable=False)
     number_of_pieces_b = Column(Integer, nullable=False)
@@ -76,7 +85,56 @@ class Catalog(BaseModel):
 class SagasHistory(BaseModel):
     """Sagas history database table representation."""
     __tablename__ = "sagas"
+    __table_args__ = (
+        # Ventana temporal de /order/saga-stats
+        Index("ix_sagas_creation_date", "creation_date"),
+    )
     id = Column(Integer, primary_key=True)
     id_order = Column(Integer, nullable=False)
     status = Column(String(256), nullable=False)
 
+
+
+class OrderStatusCounter(Base):
+    """Number of orders per client and status, kept in step with every status change.
+
+    The row with id_client GLOBAL_CLIENT holds the totals of every client.
+    """
+    GLOBAL_CLIENT = 0
+
+    __tablename__ = "order_status_counters"
+    id_client = Column(Integer, primary_key=True)
+    status = Column(String(256), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(Base):
+    """Idempotency-Key of a POST /create_order request and the response it produced.
+
+    response is NULL while the first request is still running; expires_at is then the end of its claim.
+    """
+    __tablename__ = "idempotency_keys"
+    key = Column(String(128), primary_key=True)
+    id_client = Column(Integer, primary_key=True)
+    response = Column(TEXT, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    # SHA-256 del cuerpo de la peticion: la clave no se puede reutilizar con otro pedido
+    request_hash = Column(String(64), nullable=True)
+
+
+def add_missing_columns(connection):
+    """Add the nullable columns missing in existing tables (create_all only creates new tables)."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def create_missing_indexes(connection):
+    """Create the indexes missing in existing tables (create_all only creates them with new tables)."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Classes for Request/Response schema definitions."""
 # pylint: disable=too-few-public-methods
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 from pydantic import BaseModel, Field, ConfigDict  # pylint: disable=no-name-in-module
 
@@ -74,6 +74,91 @@ class Order(OrderBase):
     )
 
 
+class OrderSummary(BaseModel):
+    """Lightweight order projection used by the paginated listing."""
+    id: int = Field(description="Primary key/identifier of the order.", example=1)
+    id_client: int = Field(description="Identifier of the client.", example=1)
+    status: str = Field(description="Current status of the order", example="Queued")
+    number_of_pieces_a: int = Field(description="Number of pieces of A type", example=10)
+    number_of_pieces_b: int = Field(description="Number of pieces of B type", example=10)
+    update_date: Optional[datetime] = Field(
+        default=None,
+        description="Last time the order changed.",
+        example="2022-07-22T17:32:32.193211"
+    )
+
+
+class OrderPage(BaseModel):
+    """Page of orders; pass next_after_id as after_id to get the following page."""
+    items: List[OrderSummary] = Field(description="Orders of this page, sorted by id.")
+    next_after_id: Optional[int] = Field(
+        default=None,
+        description="Cursor for the next page. Null when there are no more orders.",
+        example=50
+    )
+
+
+class OrderStats(BaseModel):
+    """Number of orders per status of a client, or of every client if id_client is null."""
+    id_client: Optional[int] = Field(default=None, description="Identifier of the client.", example=1)
+    total: int = Field(description="Number of orders.", example=12)
+    by_status: Dict[str, int] = Field(
+        description="Number of orders per status.",
+        example={"Queued": 2, "Delivered": 10}
+    )
+
+
+class SagaTransitionStats(BaseModel):
+    """Latency (seconds) between two consecutive saga statuses."""
+    from_status: str = Field(description="Status the order left.", example="Queued")
+    to_status: str = Field(description="Status the order entered.", example="Produced")
+    count: int = Field(description="Number of transitions.", example=120)
+    mean: float = Field(description="Mean latency.", example=31.2)
+    p50: float = Field(description="Median latency.", example=30.0)
+    p95: float = Field(description="95th percentile latency.", example=42.0)
+    p99: float = Field(description="99th percentile latency.", example=55.5)
+
+
+class SagaStats(BaseModel):
+    """Saga transition latencies in a time window."""
+    since: datetime = Field(description="Start of the window.")
+    until: datetime = Field(description="End of the window.")
+    orders: int = Field(description="Orders with saga rows in the window.", example=120)
+    transitions: List[SagaTransitionStats] = Field(description="Latency per transition.")
+
+
+class OrderBulkCancel(BaseModel):
+    """Filter of the orders to cancel. Orders that match every given field are canceled."""
+    ids: Optional[List[int]] = Field(default=None, description="Order identifiers.", example=[1, 2, 3])
+    id_client: Optional[int] = Field(default=None, description="Identifier of the client.", example=1)
+    status: Optional[str] = Field(
+        default=None,
+        description="Status of the orders. Only Queued orders can be canceled, so any other status is rejected.",
+        example="Queued"
+    )
+    created_from: Optional[datetime] = Field(
+        default=None,
+        description="Only orders created at or after this time.",
+        example="2022-07-22T00:00:00"
+    )
+    created_to: Optional[datetime] = Field(
+        default=None,
+        description="Only orders created before this time.",
+        example="2022-07-23T00:00:00"
+    )
+
+
+class BulkCancelJob(BaseModel):
+    """Progress of a bulk cancelation."""
+    job_id: str = Field(description="Identifier of the job.", example="3f2a9c1e4b7d4e0f9a8b6c5d4e3f2a1b")
+    status: str = Field(description="Running, Finished or Failed.", example="Running")
+    matched: int = Field(description="Orders moved to OrderCancelDeliveryPending.", example=1000)
+    published: int = Field(description="Compensation commands published so far.", example=500)
+    failed: int = Field(description="Compensation commands that could not be published.", example=0)
+    created_at: datetime = Field(description="Job start time.", example="2022-07-22T17:32:32.193211")
+    finished_at: Optional[datetime] = Field(default=None, description="Job end time.")
+
+
 class OrderPost(OrderBase):
     """Schema definition to create a new order."""
 
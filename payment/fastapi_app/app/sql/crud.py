@@ -3,7 +3,8 @@
 import logging
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import and_
+from sqlalchemy import and_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.future import select
 from . import models
 
@@ -190,22 +191,32 @@ async def get_balance_by_id_client(db: AsyncSession, id_client: int) -> models.P
 
 
 async def update_balance_by_id_client(db: AsyncSession, id_client: int, amount: float) -> tuple[float, bool]:
-    """Update (add or subtract) balance for a user by id_client. Creates entry if non-existent.
+    """Update (add or subtract) balance for a user by id_client with a single statement.
 
+    Credits are an upsert (the entry is created if non-existent); debits are a conditional UPDATE that
+    only applies if the balance does not go negative, so concurrent updates cannot lose or overdraw.
     Returns the balance and a boolean indicating success.
     """
-    payment = await get_balance_by_id_client(db, id_client)  # Get existing or create new payment entry
-
-    # Calculate the new balance
-    new_balance = payment.balance + amount
-    if new_balance < 0:
-        # Insufficient funds, return current balance and False
-        return payment.balance, False
-
-    # Update the balance and commit the change
-    payment.balance = new_balance
-    db.add(payment)
+    if amount >= 0:
+        stmt = sqlite_insert(models.Payment).values(id_client=id_client, balance=amount)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.Payment.id_client],
+            set_={"balance": models.Payment.balance + stmt.excluded.balance}
+        ).returning(models.Payment.balance)
+    else:
+        stmt = (
+            update(models.Payment)
+            .where(models.Payment.id_client == id_client, models.Payment.balance + amount >= 0)
+            .values(balance=models.Payment.balance + amount)
+            .returning(models.Payment.balance)
+            .execution_options(synchronize_session=False)
+        )
+    result = await db.execute(stmt)
+    balance = result.scalar()
     await db.commit()
-    await db.refresh(payment)
+    if balance is not None:
+        return balance, True
 
-    return payment.balance, True
\ No newline at end of file
+    # Insufficient funds (or no entry), return current balance and False
+    result = await db.execute(select(models.Payment.balance).where(models.Payment.id_client == id_client))
+    return result.scalar() or 0.0, False
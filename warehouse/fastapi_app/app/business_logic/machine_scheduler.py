@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Dispatch of production requests to the machines.
+
+Machines report their speed through machine.status events and the pieces they finish through
+piece.produced. Production requests wait here in a heap per piece type, highest priority class
+first and then oldest order first, and are sent to the per-machine queue (piece_x.requested.<machine>) of the live machine
+with the least expected completion time that still has credit (fewer than MACHINE_MAX_QUEUED_PIECES
+pieces pending, counting at least the queue_depth the machine last reported), keeping their AMQP priority. While no machine of a type has reported, requests go
+to the shared queue.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from app.routers import rabbitmq
+from app.business_logic.production_priority import PRIORITY_STOCK, PRIORITY_NORMAL, priority_name
+
+logger = logging.getLogger(__name__)
+
+MACHINE_SCHEDULER_ENABLED = os.getenv("MACHINE_SCHEDULER_ENABLED", "1") == "1"
+MACHINE_STATUS_TIMEOUT_SECONDS = float(os.getenv("MACHINE_STATUS_TIMEOUT_SECONDS", "30"))
+MACHINE_MAX_QUEUED_PIECES = int(os.getenv("MACHINE_MAX_QUEUED_PIECES", "20"))
+MACHINE_DEFAULT_SECONDS_PER_PIECE = float(os.getenv("MACHINE_DEFAULT_SECONDS_PER_PIECE", "3"))
+MACHINE_SCHEDULER_INTERVAL_SECONDS = float(os.getenv("MACHINE_SCHEDULER_INTERVAL_SECONDS", "1"))
+
+# Resumen de telemetria que publican las maquinas en machine.status
+MACHINE_TELEMETRY_FIELDS = (
+    "utilisation", "pieces_per_minute", "cycle_seconds_p95", "queue_wait_seconds_mean", "busy_slots", "slots"
+)
+
+# Dentro de una clase, las piezas de stock (sin orden) van detras de cualquier orden
+STOCK_ORDER = float("inf")
+
+
+def shared_routing_key(piece_type):
+    return f"piece_{piece_type.lower()}.requested"
+
+
+class MachineState:
+    """What the warehouse knows about one machine."""
+
+    def __init__(self, name, piece_type):
+        self.name = name
+        self.piece_type = piece_type
+        self.outstanding = 0
+        self.reported_depth = 0
+        self.seconds_per_piece = MACHINE_DEFAULT_SECONDS_PER_PIECE
+        self.last_seen = 0.0
+        self.dispatched = 0
+        self.produced = 0
+        self.telemetry = {}
+
+    def alive(self, now):
+        return now - self.last_seen <= MACHINE_STATUS_TIMEOUT_SECONDS
+
+    def pending(self):
+        """Pieces still to produce: the ones sent by this scheduler, or more if the machine reports them."""
+        # Tras un reinicio, o con varias replicas del warehouse, la maquina tiene trabajo que aqui no consta
+        return max(self.outstanding, self.reported_depth)
+
+    def has_credit(self, pieces):
+        pending = self.pending()
+        return pending == 0 or pending + pieces <= MACHINE_MAX_QUEUED_PIECES
+
+    def expected_completion(self, pieces):
+        """Seconds until this machine would finish `pieces` more pieces."""
+        return (self.pending() + pieces) * self.seconds_per_piece
+
+    def as_dict(self, now):
+        return {
+            "piece_type": self.piece_type,
+            "alive": self.alive(now),
+            "outstanding": self.outstanding,
+            "reported_depth": self.reported_depth,
+            "seconds_per_piece": self.seconds_per_piece,
+            "dispatched": self.dispatched,
+            "produced": self.produced,
+            "telemetry": self.telemetry
+        }
+
+
+class MachineScheduler:
+    """Least expected completion time dispatcher with priority for older orders."""
+
+    def __init__(self):
+        self.machines = {}
+        self._waiting = {}
+        self._sequence = itertools.count()
+        self._wake_up = asyncio.Event()
+        self.fallback_dispatches = 0
+        self.dispatched_requests = 0
+        self.total_wait_seconds = 0.0
+
+    def submit(self, piece_type, piece_ids, id_order=None, priority=None):
+        """Queue the production request of a chunk of pieces of the same order."""
+        if priority is None:
+            priority = PRIORITY_STOCK if id_order is None else PRIORITY_NORMAL
+        heapq.heappush(
+            self._waiting.setdefault(piece_type, []),
+            (
+                -priority, STOCK_ORDER if id_order is None else id_order,
+                next(self._sequence), time.monotonic(), list(piece_ids)
+            )
+        )
+        self._wake_up.set()
+
+    def reprioritize(self, piece_type, piece_ids, id_order, priority):
+        """Move the waiting requests of the given pieces (e.g. stock assigned to an order) to the order's class.
+
+        Returns the number of pieces moved; the ones already sent to a machine keep their priority.
+        """
+        waiting = self._waiting.get(piece_type)
+        piece_ids = set(piece_ids)
+        if not waiting or not piece_ids:
+            return 0
+        kept, moved = [], []
+        for request in waiting:
+            taken = [id_piece for id_piece in request[4] if id_piece in piece_ids]
+            if not taken:
+                kept.append(request)
+                continue
+            rest = [id_piece for id_piece in request[4] if id_piece not in piece_ids]
+            if rest:
+                kept.append(request[:4] + (rest,))
+            # Conserva la hora de peticion original
+            moved.append((-priority, id_order, next(self._sequence), request[3], taken))
+        if not moved:
+            return 0
+        # En el sitio: dispatch puede estar recorriendo esta misma lista
+        waiting[:] = kept + moved
+        heapq.heapify(waiting)
+        self._wake_up.set()
+        return sum(len(request[4]) for request in moved)
+
+    def update_status(self, report):
+        """Apply a machine.status event."""
+        machine = self.machines.get(report['machine'])
+        if machine is None:
+            machine = self.machines[report['machine']] = MachineState(report['machine'], report['piece_type'])
+        if report.get('seconds_per_piece'):
+            machine.seconds_per_piece = report['seconds_per_piece']
+        if report.get('queue_depth') is not None:
+            machine.reported_depth = max(0, report['queue_depth'])
+        machine.telemetry = {key: report[key] for key in MACHINE_TELEMETRY_FIELDS if key in report}
+        machine.last_seen = time.monotonic()
+        self._wake_up.set()
+
+    def record_produced(self, machine_name, pieces):
+        """Apply a piece.produced event of a machine."""
+        machine = self.machines.get(machine_name)
+        if machine is not None:
+            machine.outstanding = max(0, machine.outstanding - pieces)
+            machine.reported_depth = max(0, machine.reported_depth - pieces)
+            machine.produced += pieces
+            self._wake_up.set()
+
+    def _choose_machine(self, piece_type, pieces, now):
+        candidates = [
+            machine for machine in self.machines.values()
+            if machine.piece_type == piece_type and machine.alive(now)
+        ]
+        if not candidates:
+            return None, False
+        with_credit = [machine for machine in candidates if machine.has_credit(pieces)]
+        if not with_credit:
+            return None, True
+        return min(with_credit, key=lambda machine: machine.expected_completion(pieces)), True
+
+    async def dispatch(self):
+        """Send every waiting request that can be assigned now."""
+        now = time.monotonic()
+        dispatched_ids = []
+        for piece_type, waiting in self._waiting.items():
+            while waiting:
+                negative_priority, _, _, submitted, piece_ids = waiting[0]
+                machine, any_alive = self._choose_machine(piece_type, len(piece_ids), now)
+                if machine is None and any_alive:
+                    break
+                heapq.heappop(waiting)
+                message_body = json.dumps({"id_pieces": piece_ids})
+                if machine is None:
+                    await rabbitmq.publish(message_body, shared_routing_key(piece_type), -negative_priority)
+                    self.fallback_dispatches += 1
+                else:
+                    await rabbitmq.publish(
+                        message_body, f"{shared_routing_key(piece_type)}.{machine.name}", -negative_priority
+                    )
+                    machine.outstanding += len(piece_ids)
+                    machine.dispatched += len(piece_ids)
+                dispatched_ids.extend(piece_ids)
+                self.dispatched_requests += 1
+                self.total_wait_seconds += now - submitted
+        if dispatched_ids:
+            # Ya estan en una cola de maquina: desde aqui cuenta la antiguedad para el reenvio
+            from app.sql import crud  # pylint: disable=import-outside-toplevel
+            from app.sql.database import SessionLocal  # pylint: disable=import-outside-toplevel
+            async with SessionLocal() as db:
+                await crud.mark_pieces_requested(db, dispatched_ids)
+
+    async def run(self, interval: float = MACHINE_SCHEDULER_INTERVAL_SECONDS):
+        """Dispatch whenever something changes, and at least every `interval` seconds."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake_up.clear()
+            try:
+                await self.dispatch()
+            except Exception as exc:
+                logger.error(f"Error dispatching production requests: {exc}")
+
+    def waiting_by_priority(self):
+        """Waiting pieces per priority class."""
+        waiting_pieces = {}
+        for waiting in self._waiting.values():
+            for request in waiting:
+                name = priority_name(-request[0])
+                waiting_pieces[name] = waiting_pieces.get(name, 0) + len(request[4])
+        return waiting_pieces
+
+    def stats(self):
+        """Machines, waiting pieces per type and dispatch counters."""
+        now = time.monotonic()
+        return {
+            "enabled": MACHINE_SCHEDULER_ENABLED,
+            "machines": {name: machine.as_dict(now) for name, machine in self.machines.items()},
+            "waiting_pieces": {
+                piece_type: sum(len(request[4]) for request in waiting)
+                for piece_type, waiting in self._waiting.items()
+            },
+            "waiting_pieces_by_priority": self.waiting_by_priority(),
+            "dispatched_requests": self.dispatched_requests,
+            "fallback_dispatches": self.fallback_dispatches,
+            "mean_wait_seconds": (
+                self.total_wait_seconds / self.dispatched_requests if self.dispatched_requests else 0.0
+            )
+        }
+
+
+machine_scheduler = MachineScheduler()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Priority classes of the production requests and their latency.
+
+Production messages carry an AMQP priority (the machine queues are declared with x-max-priority),
+chosen from the order: small orders and orders of priority clients are rushed, big orders go as
+bulk and stock pieces go last. Orders older than PRIORITY_AGING_SECONDS (e.g. resubmitted after a
+restart) move up one class. The latency from the production request to piece.produced is kept
+per class.
+"""
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+PRIORITY_STOCK = 0
+PRIORITY_BULK = 3
+PRIORITY_NORMAL = 5
+PRIORITY_RUSH = 8
+MAX_PRIORITY = 9
+
+PRIORITY_NAMES = {
+    PRIORITY_STOCK: "stock",
+    PRIORITY_BULK: "bulk",
+    PRIORITY_NORMAL: "normal",
+    PRIORITY_RUSH: "rush"
+}
+
+PRIORITY_RUSH_MAX_PIECES = int(os.getenv("PRIORITY_RUSH_MAX_PIECES", "5"))
+PRIORITY_BULK_MIN_PIECES = int(os.getenv("PRIORITY_BULK_MIN_PIECES", "100"))
+PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "600"))
+PRIORITY_CLIENTS = {
+    int(id_client) for id_client in os.getenv("PRIORITY_CLIENTS", "").split(",") if id_client.strip()
+}
+PRODUCTION_LATENCY_SAMPLES = int(os.getenv("PRODUCTION_LATENCY_SAMPLES", "1000"))
+PRODUCTION_LATENCY_TRACKED_PIECES = int(os.getenv("PRODUCTION_LATENCY_TRACKED_PIECES", "100000"))
+
+
+def production_priority(pieces, id_client=None, age_seconds: float = 0.0):
+    """Priority of the production of an order of `pieces` pieces."""
+    if id_client is not None and id_client in PRIORITY_CLIENTS:
+        return PRIORITY_RUSH
+    if pieces <= PRIORITY_RUSH_MAX_PIECES:
+        priority = PRIORITY_RUSH
+    elif pieces >= PRIORITY_BULK_MIN_PIECES:
+        priority = PRIORITY_BULK
+    else:
+        priority = PRIORITY_NORMAL
+    if age_seconds >= PRIORITY_AGING_SECONDS:
+        priority = min(PRIORITY_RUSH, priority + 2)
+    return priority
+
+
+def priority_name(priority):
+    """Name of the class of a priority (the highest class not above it)."""
+    return PRIORITY_NAMES[max(value for value in PRIORITY_NAMES if value <= priority)]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+class ProductionLatency:
+    """Seconds from the production request of a piece until it is produced, per priority class."""
+
+    def __init__(
+            self, samples: int = PRODUCTION_LATENCY_SAMPLES, tracked_pieces: int = PRODUCTION_LATENCY_TRACKED_PIECES
+    ):
+        self.tracked_pieces = tracked_pieces
+        self._requested = OrderedDict()
+        self._samples = {name: deque(maxlen=samples) for name in PRIORITY_NAMES.values()}
+        self._produced = {name: 0 for name in PRIORITY_NAMES.values()}
+
+    def track(self, piece_ids, priority):
+        """Remember when the production of the pieces was requested."""
+        now = time.monotonic()
+        name = priority_name(priority)
+        for id_piece in piece_ids:
+            self._requested.setdefault(id_piece, (name, now))
+        # Piezas que nunca llegan a piece.produced: se olvidan las mas antiguas
+        while len(self._requested) > self.tracked_pieces:
+            self._requested.popitem(last=False)
+
+    def forget(self, piece_ids):
+        """Stop tracking pieces released by a canceled order: their request no longer has that class."""
+        for id_piece in piece_ids:
+            self._requested.pop(id_piece, None)
+
+    def record_produced(self, piece_ids):
+        """Take the latency of the produced pieces. Unknown pieces are ignored."""
+        now = time.monotonic()
+        for id_piece in piece_ids:
+            requested = self._requested.pop(id_piece, None)
+            if requested is not None:
+                name, requested_at = requested
+                self._samples[name].append(now - requested_at)
+                self._produced[name] += 1
+
+    def stats(self):
+        """Latency percentiles of the last samples and pieces in production, per class."""
+        in_production = {name: 0 for name in PRIORITY_NAMES.values()}
+        for name, _ in self._requested.values():
+            in_production[name] += 1
+        stats = {}
+        for name, samples in self._samples.items():
+            values = sorted(samples)
+            stats[name] = {
+                "produced": self._produced[name],
+                "in_production": in_production[name],
+                "mean_seconds": sum(values) / len(values) if values else 0.0,
+                "p50_seconds": percentile(values, 0.50),
+                "p95_seconds": percentile(values, 0.95),
+                "p99_seconds": percentile(values, 0.99)
+            }
+        return stats
+
+
+production_latency = ProductionLatency()
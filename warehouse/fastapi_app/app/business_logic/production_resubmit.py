@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Periodic resubmission of the production requests lost in the machine queues.
+
+A request published to a machine queue that has not produced its pieces after
+PRODUCTION_RESUBMIT_AFTER_SECONDS (e.g. the machine died with it) is requested again every
+PRODUCTION_RESUBMIT_INTERVAL_SECONDS (see crud.resubmit_queued_pieces).
+"""
+import asyncio
+import logging
+import os
+from app.sql import crud
+from app.sql.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+PRODUCTION_RESUBMIT_INTERVAL_SECONDS = float(os.getenv("PRODUCTION_RESUBMIT_INTERVAL_SECONDS", "60"))
+
+
+async def resubmit_stale_pieces_periodically(interval: float = PRODUCTION_RESUBMIT_INTERVAL_SECONDS):
+    """Resubmit the stale dispatched production requests every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with SessionLocal() as db:
+                # Las no enviadas siguen en el heap de este proceso
+                await crud.resubmit_queued_pieces(db, undispatched=False)
+        except Exception as exc:
+            logger.error(f"Error resubmitting stale production requests: {exc}")
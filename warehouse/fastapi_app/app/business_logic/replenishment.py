@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Make-to-stock replenishment of free pieces.
+
+For each piece type, when the free stock (ready + being produced) falls below STOCK_REORDER_<TYPE>,
+production is requested up to STOCK_TARGET_<TYPE>, without ever having more than
+STOCK_MAX_IN_PRODUCTION_<TYPE> stock pieces queued in the machines, so orders are not delayed
+behind stock production. A target of 0 (the default) disables replenishment for that type.
+"""
+import asyncio
+import logging
+import os
+from app.sql import crud
+from app.sql.database import SessionLocal
+from .stock_index import stock_index
+
+logger = logging.getLogger(__name__)
+
+PIECE_TYPES = ("A", "B")
+REPLENISHMENT_INTERVAL_SECONDS = float(os.getenv("REPLENISHMENT_INTERVAL_SECONDS", "5"))
+
+
+class StockLevels:
+    """Replenishment levels of a piece type."""
+
+    def __init__(self, piece_type):
+        self.target = int(os.getenv(f"STOCK_TARGET_{piece_type}", "0"))
+        self.reorder = int(os.getenv(f"STOCK_REORDER_{piece_type}", str(self.target // 2)))
+        self.max_in_production = int(os.getenv(f"STOCK_MAX_IN_PRODUCTION_{piece_type}", "5"))
+
+
+class ReplenishmentPlanner:
+    """Keeps the free stock of every piece type between its reorder and target levels."""
+
+    def __init__(self, piece_types):
+        self.levels = {piece_type: StockLevels(piece_type) for piece_type in piece_types}
+        self.requested = {piece_type: 0 for piece_type in piece_types}
+        self.ordered = {piece_type: 0 for piece_type in piece_types}
+        self.served_from_stock = {piece_type: 0 for piece_type in piece_types}
+        self._wake_up = asyncio.Event()
+
+    def record_allocation(self, pieces_by_type: dict, from_stock: dict):
+        """Count the pieces ordered and how many were served from produced stock, and wake up."""
+        for piece_type, number in pieces_by_type.items():
+            if piece_type in self.ordered:
+                self.ordered[piece_type] += number
+                self.served_from_stock[piece_type] += from_stock.get(piece_type, 0)
+        self._wake_up.set()
+
+    def shortfall(self, piece_type):
+        """Pieces to request now for a type (0 if the stock is above the reorder level)."""
+        levels = self.levels[piece_type]
+        free = stock_index.free(piece_type)
+        if levels.target <= 0 or free >= levels.reorder:
+            return 0
+        capacity = levels.max_in_production - stock_index.pending(piece_type)
+        return max(0, min(levels.target - free, capacity))
+
+    async def replenish(self):
+        """Request production of the missing stock of every type."""
+        for piece_type in self.levels:
+            number = self.shortfall(piece_type)
+            if number > 0:
+                async with SessionLocal() as db:
+                    await crud.create_stock_pieces(db, piece_type, number)
+                self.requested[piece_type] += number
+                logger.info("Requested %i stock pieces of type %s", number, piece_type)
+
+    async def run(self, interval: float = REPLENISHMENT_INTERVAL_SECONDS):
+        """Replenish every `interval` seconds, or earlier after an allocation."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake_up.clear()
+            try:
+                await self.replenish()
+            except Exception as exc:
+                logger.error(f"Error replenishing stock: {exc}")
+
+    def stats(self):
+        """Levels, stock and fill rate (pieces served from produced stock / pieces ordered) per type."""
+        return {
+            piece_type: {
+                "target": levels.target,
+                "reorder": levels.reorder,
+                "max_in_production": levels.max_in_production,
+                "free": stock_index.free(piece_type),
+                "in_production": stock_index.pending(piece_type),
+                "requested": self.requested[piece_type],
+                "ordered": self.ordered[piece_type],
+                "served_from_stock": self.served_from_stock[piece_type],
+                "fill_rate": (
+                    self.served_from_stock[piece_type] / self.ordered[piece_type]
+                    if self.ordered[piece_type] else 0.0
+                )
+            }
+            for piece_type, levels in self.levels.items()
+        }
+
+
+replenishment_planner = ReplenishmentPlanner(PIECE_TYPES)
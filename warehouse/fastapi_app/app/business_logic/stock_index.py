@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""In-memory index of the free pieces (not assigned to any order) of the warehouse.
+
+Free pieces are kept per type in two pools: ready (already produced) and pending (queued in a
+machine). It is rebuilt from the database at startup and updated by crud after every commit that
+assigns, releases or produces pieces, so allocation can pick pieces without scanning the table.
+"""
+from app.sql import models
+
+POOL_READY = "ready"
+POOL_PENDING = "pending"
+
+POOL_BY_STATUS = {
+    models.Piece.STATUS_PRODUCED: POOL_READY,
+    models.Piece.STATUS_QUEUED: POOL_PENDING
+}
+
+
+class PiecePool:
+    """Set of piece ids backed by an array, with O(1) add, remove and take."""
+
+    def __init__(self):
+        self._ids = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id_piece):
+        return id_piece in self._positions
+
+    def add(self, id_piece):
+        if id_piece not in self._positions:
+            self._positions[id_piece] = len(self._ids)
+            self._ids.append(id_piece)
+
+    def discard(self, id_piece):
+        position = self._positions.pop(id_piece, None)
+        if position is None:
+            return False
+        last = self._ids.pop()
+        if last != id_piece:
+            self._ids[position] = last
+            self._positions[last] = position
+        return True
+
+    def peek(self, number):
+        """Return up to `number` ids without removing them."""
+        return self._ids[-number:] if number > 0 else []
+
+
+class StockIndex:
+    """Free pieces per type and pool."""
+
+    def __init__(self):
+        self._pools = {}
+
+    def _pool(self, piece_type, pool):
+        return self._pools.setdefault(piece_type, {POOL_READY: PiecePool(), POOL_PENDING: PiecePool()})[pool]
+
+    def rebuild(self, pieces):
+        """Replace the index with the given (id_piece, piece_type, status_piece) free pieces."""
+        self._pools = {}
+        for id_piece, piece_type, status_piece in pieces:
+            self.update(id_piece, piece_type, status_piece, None)
+
+    def update(self, id_piece, piece_type, status_piece, id_order):
+        """Reflect the committed state of a piece."""
+        for pool in (POOL_READY, POOL_PENDING):
+            self._pool(piece_type, pool).discard(id_piece)
+        pool = POOL_BY_STATUS.get(status_piece)
+        if id_order is None and pool is not None:
+            self._pool(piece_type, pool).add(id_piece)
+
+    def remove(self, piece_type, piece_ids):
+        """Forget pieces that are no longer free."""
+        for id_piece in piece_ids:
+            for pool in (POOL_READY, POOL_PENDING):
+                self._pool(piece_type, pool).discard(id_piece)
+
+    def candidates(self, piece_type, number):
+        """Up to `number` free pieces of a type to assign to an order, produced ones first."""
+        ready = self._pool(piece_type, POOL_READY).peek(number)
+        return ready + self._pool(piece_type, POOL_PENDING).peek(number - len(ready))
+
+    def free(self, piece_type):
+        """Number of free pieces of a type."""
+        return len(self._pool(piece_type, POOL_READY)) + len(self._pool(piece_type, POOL_PENDING))
+
+    def pending(self, piece_type):
+        """Number of free pieces of a type still being produced."""
+        return len(self._pool(piece_type, POOL_PENDING))
+
+    def summary(self):
+        """Free pieces per type and pool."""
+        return {
+            piece_type: {
+                POOL_READY: len(pools[POOL_READY]),
+                POOL_PENDING: len(pools[POOL_PENDING]),
+                "free": len(pools[POOL_READY]) + len(pools[POOL_PENDING])
+            }
+            for piece_type, pools in self._pools.items()
+        }
+
+
+stock_index = StockIndex()
@@ -11,7 +11,10 @@ from .consulService.BLConsul import register_consul_service, unregister_consul_s
 from fastapi import FastAPI
 from app.routers import main_router, rabbitmq, rabbitmq_publish_logs
 from app.sql import models
-from app.sql import database
+from app.sql import database, crud
+from app.business_logic.replenishment import replenishment_planner
+from app.business_logic.machine_scheduler import machine_scheduler
+from app.business_logic.production_resubmit import resubmit_stale_pieces_periodically
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 # Configure logging ################################################################################
 print("Name: ", __name__)
@@ -62,7 +65,13 @@ async def startup_event():
         logger.info("Creating database tables")
         async with database.engine.begin() as conn:
             await conn.run_sync(models.Base.metadata.create_all)
+            await conn.run_sync(models.add_missing_columns)
+            await conn.run_sync(models.create_missing_indexes)
+        async with database.SessionLocal() as db:
+            await crud.rebuild_stock_index(db)
         await rabbitmq.subscribe_channel()
+        async with database.SessionLocal() as db:
+            await crud.resubmit_queued_pieces(db)
         await rabbitmq_publish_logs.subscribe_channel()
         logger.info("Se ha suscrito")
 
@@ -73,6 +82,10 @@ async def startup_event():
         asyncio.create_task(rabbitmq.subscribe_delivery_cancel())
         asyncio.create_task(rabbitmq.subscribe_check_warehouse_order_cancel())
         asyncio.create_task(rabbitmq.subscribe_delivering())
+        asyncio.create_task(replenishment_planner.run())
+        asyncio.create_task(rabbitmq.subscribe_machine_status())
+        asyncio.create_task(machine_scheduler.run())
+        asyncio.create_task(resubmit_stale_pieces_periodically())
         try:
             task = asyncio.create_task(update_system_resources_periodically(15))
         except Exception as e:
@@ -18,7 +18,13 @@ from .router_utils import raise_and_log_error
 from typing import Dict
 from global_variables.global_variables import rabbitmq_working, system_values
 from global_variables.global_variables import get_rabbitmq_status
-from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.sql.database import SessionLocal
+from app.business_logic.stock_index import stock_index
+from app.business_logic.replenishment import replenishment_planner
+from app.business_logic.machine_scheduler import machine_scheduler
+from app.business_logic.production_priority import production_latency
 
 with open("/keys/priv.pem", "r") as priv_file:
     PRIVATE_KEY = priv_file.read()
@@ -30,6 +36,9 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+WAREHOUSE_PAGE_DEFAULT_LIMIT = 100
+WAREHOUSE_PAGE_MAX_LIMIT = 1000
+
 # Claves de JWT y configuración
 
 
@@ -195,8 +204,9 @@ async def health_check():
     summary="Retrieve catalog of pieces",
     responses={
         status.HTTP_200_OK: {
-            "model": schemas.Piece,
-            "description": "Requested Pieces."
+            "model": List[schemas.Piece],
+            "description": "Requested Pieces, sorted by id_piece. The X-Next-After-Id header has the cursor "
+                           "of the next page. With stream=true, every matching piece as NDJSON."
         },
         status.HTTP_404_NOT_FOUND: {
             "model": schemas.Message, "description": "Warehouse not found"
@@ -205,8 +215,12 @@ async def health_check():
     tags=['Warehouse']
 )
 async def get_warehouse(
-    id_order: int = Query(None, description="Order ID"),
+    id_order: int = Query(None, description="Order ID (-1 for pieces without order)"),
     piece_type: str = Query(None, description="Piece type"),
+    after_id: int = Query(None, description="Return pieces with id_piece greater than this (X-Next-After-Id)"),
+    limit: int = Query(WAREHOUSE_PAGE_DEFAULT_LIMIT, ge=1, le=WAREHOUSE_PAGE_MAX_LIMIT, description="Page size"),
+    fields: str = Query(None, description="Comma separated piece fields to return, e.g. id_piece,status_piece"),
+    stream: bool = Query(False, description="Stream every matching piece as NDJSON instead of a page"),
     db: AsyncSession = Depends(dependencies.get_db),
     current_user: Dict = Depends(get_current_user),
 
@@ -227,18 +241,22 @@ async def get_warehouse(
             )
         logger.debug("GET '/warehouse' endpoint called.")
 
-        if id_order is None and piece_type is None:
-            order_list = await crud.get_all_pieces(db)
-        elif id_order is not None and piece_type is None:
-            if id_order == -1:
-                id_order = None
-            order_list = await crud.get_order_pieces(db, id_order)
-        elif id_order is None and piece_type is not None:
-            order_list = await crud.get_pieces_by_type(db, piece_type)
-        elif id_order is not None and piece_type is not None:
-            if id_order == -1:
-                id_order = None
-            order_list = await crud.get_order_pieces_by_type(db, id_order, piece_type)
+        selected_fields = crud.PIECE_FIELDS
+        if fields:
+            selected_fields = tuple(field.strip() for field in fields.split(",") if field.strip())
+            unknown = set(selected_fields) - set(crud.PIECE_FIELDS)
+            if unknown:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unknown piece fields: {', '.join(sorted(unknown))}"
+                )
+        stmt = crud.pieces_statement(
+            id_order=None if id_order == -1 else id_order,
+            free=id_order == -1,
+            piece_type=piece_type,
+            after_id=after_id,
+            fields=selected_fields
+        )
 
         data = {
             "message": "INFO - Piece list obtained"
@@ -246,8 +264,23 @@ async def get_warehouse(
         message_body = json.dumps(data)
         routing_key = "warehouse.get_warehouse.info"
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-        return order_list
 
+        if stream:
+            async def ndjson():
+                # Sesion propia: la de Depends se cierra antes de enviar la respuesta
+                async with SessionLocal() as stream_db:
+                    async for piece in crud.stream_pieces(stream_db, stmt):
+                        yield json.dumps(jsonable_encoder(piece)) + "\n"
+            return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+        pieces = await crud.get_pieces_page(db, stmt, limit)
+        headers = {}
+        if len(pieces) == limit:
+            headers["X-Next-After-Id"] = str(pieces[-1]["id_piece"])
+        return JSONResponse(content=jsonable_encoder(pieces), headers=headers)
+
+    except HTTPException:
+        raise
     except Exception as exc:
         print("Error retrieving pieces catalog")
         data = {
@@ -258,3 +291,126 @@ async def get_warehouse(
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
         raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error obtaining order list: {exc}")
 
+
+@router.get(
+    "/warehouse/summary",
+    summary="Number of pieces per type, status and assigned/free",
+    tags=['Warehouse']
+)
+async def get_warehouse_summary(
+    db: AsyncSession = Depends(dependencies.get_db),
+    current_user: Dict = Depends(get_current_user)
+):
+    """Piece counts computed by the database with a single GROUP BY."""
+    logger.debug("GET '/warehouse/summary' endpoint called.")
+    if current_user["role"] != "admin":
+        data = {
+            "message": "ERROR - You don't have permissions"
+        }
+        message_body = json.dumps(data)
+        routing_key = "warehouse.get_warehouse_summary.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see the warehouse summary."
+        )
+    summary = await crud.get_pieces_summary(db)
+    data = {
+        "message": "INFO - Warehouse summary obtained"
+    }
+    message_body = json.dumps(data)
+    routing_key = "warehouse.get_warehouse_summary.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return summary
+
+
+@router.get(
+    "/warehouse/stock",
+    summary="Free pieces per type",
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Free pieces (not assigned to an order) per type: ready, pending and free."
+        }
+    },
+    tags=['Warehouse']
+)
+async def get_warehouse_stock(
+    current_user: Dict = Depends(get_current_user)
+):
+    """Stock summary from the in-memory index, without querying the database."""
+    logger.debug("GET '/warehouse/stock' endpoint called.")
+    if current_user["role"] != "admin":
+        data = {
+            "message": "ERROR - You don't have permissions"
+        }
+        message_body = json.dumps(data)
+        routing_key = "warehouse.get_warehouse_stock.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see the stock."
+        )
+    data = {
+        "message": "INFO - Stock obtained"
+    }
+    message_body = json.dumps(data)
+    routing_key = "warehouse.get_warehouse_stock.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return stock_index.summary()
+
+
+@router.get(
+    "/warehouse/replenishment",
+    summary="Stock replenishment levels and fill rate",
+    tags=['Warehouse']
+)
+async def get_warehouse_replenishment(
+    current_user: Dict = Depends(get_current_user)
+):
+    """Target/reorder levels, stock in production and fill rate per piece type."""
+    logger.debug("GET '/warehouse/replenishment' endpoint called.")
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see the replenishment metrics."
+        )
+    return replenishment_planner.stats()
+
+
+@router.get(
+    "/warehouse/scheduler",
+    summary="Machine scheduler metrics",
+    tags=['Warehouse']
+)
+async def get_warehouse_scheduler(
+    current_user: Dict = Depends(get_current_user)
+):
+    """Known machines with their load and speed, waiting pieces and dispatch counters."""
+    logger.debug("GET '/warehouse/scheduler' endpoint called.")
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see the scheduler metrics."
+        )
+    return machine_scheduler.stats()
+
+
+@router.get(
+    "/warehouse/priorities",
+    summary="Production latency per priority class",
+    tags=['Warehouse']
+)
+async def get_warehouse_priorities(
+    current_user: Dict = Depends(get_current_user)
+):
+    """Request-to-produced latency percentiles, pieces in production and waiting pieces per priority class."""
+    logger.debug("GET '/warehouse/priorities' endpoint called.")
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access forbidden: only admins can see the priority metrics."
+        )
+    return {
+        "latency": production_latency.stats(),
+        "waiting": machine_scheduler.waiting_by_priority()
+    }
@@ -4,6 +4,9 @@ import json
 from app.sql.database import SessionLocal  # pylint: disable=import-outside-toplevel
 from app.sql import crud
 from app.sql import models, schemas
+from app.business_logic.replenishment import replenishment_planner
+from app.business_logic.machine_scheduler import machine_scheduler
+from app.business_logic.production_priority import production_latency
 import logging
 import ssl
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
@@ -89,66 +92,30 @@ async def on_piece_order(message):
 
             db = SessionLocal()
 
-            # Procesar piezas de tipo A
-            for _ in range(0, pieces_ordered['number_of_pieces_a']):
-                db_pieces = await crud.get_order_pieces_by_type(db, None, "A")
-                if db_pieces:
-                    try:
-                        db_piece = await crud.change_piece_order_id(db, db_pieces[0].id_piece, pieces_ordered['id_order'])
-                        logger.debug(f"Pieza A actualizada: {db_piece}")
-                    except Exception as e:
-                        logger.error(f"Error al cambiar el ID de la orden de la pieza A: {e}")
-                        return
-                else:
-                    piece = schemas.PieceBase(
-                        piece_type="A",
-                        status_piece=models.Piece.STATUS_QUEUED,
-                        id_order=pieces_ordered['id_order'],
-                        id_client=pieces_ordered['id_client']
-                    )
-                    try:
-                        await crud.create_piece(db, piece)
-                        logger.debug(f"Pieza A creada: {piece}")
-                    except Exception as e:
-                        logger.error(f"Error al crear una nueva pieza A: {e}")
-                        return
-
-            # Procesar piezas de tipo B
-            for _ in range(0, pieces_ordered['number_of_pieces_b']):
-                db_pieces = await crud.get_order_pieces_by_type(db, None, "B")
-                if db_pieces:
-                    try:
-                        db_piece = await crud.change_piece_order_id(db, db_pieces[0].id_piece, pieces_ordered['id_order'])
-                        logger.debug(f"Pieza B actualizada: {db_piece}")
-                    except Exception as e:
-                        logger.error(f"Error al cambiar el ID de la orden de la pieza B: {e}")
-                        return
-                else:
-                    piece = schemas.PieceBase(
-                        piece_type="B",
-                        status_piece=models.Piece.STATUS_QUEUED,
-                        id_order=pieces_ordered['id_order'],
-                        id_client=pieces_ordered['id_client']
-                    )
-                    try:
-                        await crud.create_piece(db, piece)
-                        logger.debug(f"Pieza B creada: {piece}")
-                    except Exception as e:
-                        logger.error(f"Error al crear una nueva pieza B: {e}")
-                        return
-
-            try:
-                data = {
-                    "id_order": pieces_ordered['id_order'],
-                    "id_client": pieces_ordered['id_client']
-                }
-                message_body = json.dumps(data)
-                routing_key = "orders.produced"
-                logger.debug(f"Publicando mensaje: {message_body} en routing_key: {routing_key}")
-                await publish(message_body, routing_key)
-            except Exception as e:
-                logger.error(f"Error al publicar el mensaje: {e}")
-                return
+            pieces_by_type = {"A": pieces_ordered['number_of_pieces_a'], "B": pieces_ordered['number_of_pieces_b']}
+            allocation = await crud.allocate_order_pieces(
+                db,
+                pieces_ordered['id_order'],
+                pieces_ordered['id_client'],
+                pieces_by_type
+            )
+            replenishment_planner.record_allocation(pieces_by_type, allocation['from_stock'])
+            logger.debug(f"Piezas asignadas a la orden {pieces_ordered['id_order']}: {allocation}")
+
+            # Si todas las piezas ya estaban fabricadas la orden esta terminada; si no, lo avisa on_piece_message
+            if not allocation['pending']:
+                try:
+                    data = {
+                        "id_order": pieces_ordered['id_order'],
+                        "id_client": pieces_ordered['id_client']
+                    }
+                    message_body = json.dumps(data)
+                    routing_key = "orders.produced"
+                    logger.debug(f"Publicando mensaje: {message_body} en routing_key: {routing_key}")
+                    await publish(message_body, routing_key)
+                except Exception as e:
+                    logger.error(f"Error al publicar el mensaje: {e}")
+                    return
 
         except Exception as e:
             logger.error(f"Error general en on_piece_order: {e}")
@@ -177,14 +144,11 @@ async def on_check_warehouse_order_cancel_message(message):
         order_canceled = json.loads(message.body)
         status_cancel = True
         try:
-            db = SessionLocal()
-            db_pieces = await crud.get_order_pieces(db, order_canceled['order_id'])
-            await db.close()
-            for piece in db_pieces:
-                db = SessionLocal()
-                db_piece = await crud.change_piece_order_id(db, piece.id_piece, None)
-                await db.close()
+            async with SessionLocal() as db:
+                released = await crud.release_order_pieces(db, order_canceled['order_id'])
+            logger.debug(f"{released} piezas liberadas de la orden {order_canceled['order_id']}")
         except Exception as e:
+            logger.error(f"Error al liberar las piezas de la orden {order_canceled['order_id']}: {e}")
             status_cancel = False
         data = {
             "order_id": order_canceled['order_id'],
@@ -211,24 +175,18 @@ async def subscribe_check_warehouse_order_cancel():
 async def on_piece_message(message):
     async with message.process():
         piece_recieve = json.loads(message.body)
+        # Lote {"id_pieces": [...]} o pieza suelta {"id_piece": n}
+        piece_ids = piece_recieve['id_pieces'] if 'id_pieces' in piece_recieve else [piece_recieve['id_piece']]
+        if 'machine' in piece_recieve:
+            machine_scheduler.record_produced(piece_recieve['machine'], len(piece_ids))
+        production_latency.record_produced(piece_ids)
         db = SessionLocal()
-        db_piece = await crud.change_piece_status(db, piece_recieve['id_piece'], models.Piece.STATUS_PRODUCED)
-        if (db_piece.id_order != None):
-            db_pieces = await crud.get_order_pieces(db, db_piece.id_order)
-            order_finished = True
-            for piece in db_pieces:
-                if piece.status_piece == models.Piece.STATUS_QUEUED:
-                    order_finished = False
-                    break
-            if order_finished:
-                data = {
-                    "id_order": db_piece.id_order,
-                    "id_client": db_piece.id_client
-                }
-                message_body = json.dumps(data)
-                routing_key = "orders.produced"
-                await publish(message_body, routing_key)
+        finished_orders = await crud.mark_pieces_produced(db, piece_ids)
         await db.close()
+        routing_key = "orders.produced"
+        await asyncio.gather(*(
+            publish(json.dumps(order), routing_key) for order in finished_orders
+        ))
 
 
 async def subscribe_pieces():
@@ -244,6 +202,25 @@ async def subscribe_pieces():
             await on_piece_message(message)
 
 
+async def on_machine_status_message(message):
+    async with message.process():
+        report = json.loads(message.body)
+        machine_scheduler.update_status(report)
+
+
+async def subscribe_machine_status():
+    # Create a queue
+    queue_name = "warehouse.machine_status"
+    queue = await channel.declare_queue(name=queue_name, exclusive=False)
+    # Bind the queue to the exchange
+    routing_key = "machine.status"
+    await queue.bind(exchange=exchange_name, routing_key=routing_key)
+    # Set up a message consumer
+    async with queue.iterator() as queue_iter:
+        async for message in queue_iter:
+            await on_machine_status_message(message)
+
+
 async def subscribe_delivery_cancel():
     # Create queue
     queue_name = "warehouse.cancel_check"
@@ -260,22 +237,21 @@ async def subscribe_delivery_cancel():
 async def on_delivering(message):
     async with message.process():
         delivery = json.loads(message.body)
-        db = SessionLocal()
-        db_pieces = await crud.get_order_pieces(db, delivery['id_order'])
-        await db.close()
-        for piece in db_pieces:
-            db = SessionLocal()
-            await crud.change_piece_status(db, piece.id_piece, models.Piece.STATUS_SHIPPED)
-            await db.close()
+        # Oleada {"orders": [{"id_order", "id_client"}, ...]} o pedido suelto {"id_order", "id_client"}
+        id_orders = [order['id_order'] for order in delivery.get('orders', [delivery])]
+        async with SessionLocal() as db:
+            shipped = await crud.set_order_pieces_status(db, id_orders, models.Piece.STATUS_SHIPPED)
+        logger.debug(f"{shipped} piezas enviadas de las ordenes {id_orders}")
 
 
 async def subscribe_delivering():
-    queue_name = "orders.delivering"
+    # Cola propia: la cola "orders.delivering" es la de orders y se repartirian los mensajes
+    queue_name = "warehouse.orders_delivering"
     queue = await channel.declare_queue(name=queue_name, exclusive=False)
     # Bind the queue to the exchange
     routing_key = "orders.delivering"
-
-    await queue.bind(exchange=exchange_responses_name, routing_key=routing_key)
+    # delivery publica orders.delivering en el exchange de eventos
+    await queue.bind(exchange=exchange_name, routing_key=routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
@@ -287,14 +263,11 @@ async def on_message_delivery_cancel(message):
         order_canceled = json.loads(message.body)
         status_canceled = True
         try:
-            db = SessionLocal()
-            db_pieces = await crud.get_order_pieces(db, order_canceled['id_order'])
-            await db.close()
-            for piece in db_pieces:
-                db = SessionLocal()
-                db_piece = await crud.change_piece_order_id(db, piece.id_piece, None)
-                await db.close()
+            async with SessionLocal() as db:
+                released = await crud.release_order_pieces(db, order_canceled['id_order'])
+            logger.debug(f"{released} piezas liberadas de la orden {order_canceled['id_order']}")
         except Exception as e:
+            logger.error(f"Error al liberar las piezas de la orden {order_canceled['id_order']}: {e}")
             status_canceled = False
         data = {
             "id_order": order_canceled['id_order'],
@@ -306,12 +279,13 @@ async def on_message_delivery_cancel(message):
         await publish_response(message_body, routing_key)
 
 
-async def publish(message_body, routing_key):
+async def publish(message_body, routing_key, priority=None):
     # Publish the message to the exchange
     await exchange.publish(
         aio_pika.Message(
             body=message_body.encode(),
-            content_type="text/plain"
+            content_type="text/plain",
+            priority=priority
         ),
         routing_key=routing_key)
 
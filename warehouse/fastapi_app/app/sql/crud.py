@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 """Functions that interact with the database."""
+import asyncio
 import logging
 import json
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
 from sqlalchemy import or_
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
@@ -12,8 +14,11 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from .database import SessionLocal
 from ..routers.rabbitmq import publish
+from ..business_logic.stock_index import stock_index
+from ..business_logic.machine_scheduler import machine_scheduler, MACHINE_SCHEDULER_ENABLED
+from ..business_logic.production_priority import production_priority, production_latency, PRIORITY_STOCK
 from . import models
-from sqlalchemy import update
+from sqlalchemy import update, insert, delete
 
 logger = logging.getLogger(__name__)
 
@@ -74,6 +79,7 @@ async def create_piece(db: AsyncSession, piece):
     db.add(db_piece)
     await db.commit()
     await db.refresh(db_piece)
+    stock_index.update(db_piece.id_piece, db_piece.piece_type, db_piece.status_piece, db_piece.id_order)
     data = {
         "id_piece": db_piece.id_piece
     }
@@ -94,6 +100,7 @@ async def change_piece_status(db: AsyncSession, piece_id, status):
         db_piece.manufacturing_date = func.now()
     await db.commit()
     await db.refresh(db_piece)
+    stock_index.update(db_piece.id_piece, db_piece.piece_type, db_piece.status_piece, db_piece.id_order)
     return db_piece
 
 
@@ -103,6 +110,7 @@ async def change_piece_order_id(db: AsyncSession, piece_id, order_id):
     db_piece.id_order = order_id
     await db.commit()
     await db.refresh(db_piece)
+    stock_index.update(db_piece.id_piece, db_piece.piece_type, db_piece.status_piece, db_piece.id_order)
     return db_piece
 
 
@@ -131,4 +139,343 @@ async def get_order_pieces_by_type(db: AsyncSession, order_id, piece_type):
         )
     )
     pieces = await get_list_statement_result(db, stmt)
-    return pieces
\ No newline at end of file
+    return pieces
+
+
+# Piezas por mensaje de peticion de produccion ({"id_pieces": [...]})
+PRODUCTION_REQUEST_CHUNK_SIZE = int(os.getenv("PRODUCTION_REQUEST_CHUNK_SIZE", "10"))
+# Antiguedad del envio a una cola de maquina a partir de la cual la peticion se da por perdida
+PRODUCTION_RESUBMIT_AFTER_SECONDS = int(os.getenv("PRODUCTION_RESUBMIT_AFTER_SECONDS", "600"))
+
+PIECE_REQUESTED_ROUTING_KEYS = {
+    "A": "piece_a.requested",
+    "B": "piece_b.requested"
+}
+
+
+async def allocate_order_pieces(db: AsyncSession, id_order, id_client, pieces_by_type: dict):
+    """Assign free pieces to an order and create the missing ones, in a single transaction.
+
+    pieces_by_type is {piece_type: number of pieces}. The free pieces are chosen from the stock
+    index, produced ones first, and claimed only if still free in the database.
+    Production of the created pieces is requested after the commit. Returns
+    {"assigned": {type: [id_piece]}, "created": {type: [id_piece]}, "from_stock": {type: number},
+    "pending": bool}, where from_stock counts the assigned pieces that were already produced and
+    pending tells whether any piece of the order still has to be produced. In that case the order
+    progress is stored in the same transaction (see mark_piece_produced).
+    """
+    assigned, created, candidates, remaining, from_stock, queued = {}, {}, {}, {}, {}, {}
+    for piece_type, number in pieces_by_type.items():
+        assigned[piece_type], created[piece_type], queued[piece_type] = [], [], []
+        remaining[piece_type] = 0
+        if number <= 0:
+            continue
+        candidates[piece_type] = stock_index.candidates(piece_type, number)
+        if candidates[piece_type]:
+            result = await db.execute(
+                update(models.Piece)
+                .where(models.Piece.id_piece.in_(candidates[piece_type]), models.Piece.id_order.is_(None))
+                .values(id_order=id_order, id_client=id_client)
+                .returning(models.Piece.id_piece, models.Piece.status_piece)
+                .execution_options(synchronize_session=False)
+            )
+            for id_piece, status_piece in result.all():
+                assigned[piece_type].append(id_piece)
+                if status_piece == models.Piece.STATUS_QUEUED:
+                    remaining[piece_type] += 1
+                    queued[piece_type].append(id_piece)
+        from_stock[piece_type] = len(assigned[piece_type]) - remaining[piece_type]
+
+        shortfall = number - len(assigned[piece_type])
+        if shortfall > 0:
+            created[piece_type] = await insert_queued_pieces(db, piece_type, shortfall, id_order, id_client)
+            remaining[piece_type] += shortfall
+    pending = sum(remaining.values()) > 0
+    if pending:
+        db.add(models.OrderProgress(
+            id_order=id_order,
+            id_client=id_client,
+            total=sum(remaining.values()),
+            **{models.OrderProgress.REMAINING_COLUMNS[piece_type]: number for piece_type, number in remaining.items()}
+        ))
+    await db.commit()
+    # Candidates that were not claimed were no longer free either
+    for piece_type, piece_ids in candidates.items():
+        stock_index.remove(piece_type, piece_ids)
+    priority = production_priority(sum(pieces_by_type.values()), id_client)
+    if MACHINE_SCHEDULER_ENABLED:
+        # Las piezas de stock aun en produccion pasan a la clase de la orden
+        for piece_type, piece_ids in queued.items():
+            machine_scheduler.reprioritize(piece_type, piece_ids, id_order, priority)
+    await request_pieces_production(created, id_order, priority)
+    return {"assigned": assigned, "created": created, "from_stock": from_stock, "pending": pending}
+
+
+async def insert_queued_pieces(db: AsyncSession, piece_type, number, id_order=None, id_client=None):
+    """Insert `number` queued pieces with a single statement and return their ids. Does not commit."""
+    result = await db.execute(
+        insert(models.Piece).returning(models.Piece.id_piece),
+        [{
+            "piece_type": piece_type,
+            "status_piece": models.Piece.STATUS_QUEUED,
+            "id_order": id_order,
+            "id_client": id_client
+        }] * number
+    )
+    return list(result.scalars().all())
+
+
+async def create_stock_pieces(db: AsyncSession, piece_type, number):
+    """Create free pieces for the stock and request their production. Returns their ids."""
+    piece_ids = await insert_queued_pieces(db, piece_type, number)
+    await db.commit()
+    for id_piece in piece_ids:
+        stock_index.update(id_piece, piece_type, models.Piece.STATUS_QUEUED, None)
+    await request_pieces_production({piece_type: piece_ids})
+    return piece_ids
+
+
+async def mark_pieces_produced(db: AsyncSession, piece_ids):
+    """Set queued pieces as produced and decrement the progress of their orders, in one transaction.
+
+    Pieces that were not queued (e.g. a duplicated message) are ignored. Returns the orders
+    completed by these pieces as [{"id_order", "id_client"}].
+    """
+    result = await db.execute(
+        update(models.Piece)
+        .where(models.Piece.id_piece.in_(piece_ids), models.Piece.status_piece == models.Piece.STATUS_QUEUED)
+        .values(status_piece=models.Piece.STATUS_PRODUCED, manufacturing_date=func.now())
+        .returning(models.Piece.id_piece, models.Piece.id_order, models.Piece.id_client, models.Piece.piece_type)
+        .execution_options(synchronize_session=False)
+    )
+    pieces = result.all()
+    if not pieces:
+        await db.rollback()
+        return []
+    produced_by_order, clients = {}, {}
+    for piece in pieces:
+        if piece.id_order is not None:
+            column = models.OrderProgress.REMAINING_COLUMNS[piece.piece_type]
+            counts = produced_by_order.setdefault(piece.id_order, {})
+            counts[column] = counts.get(column, 0) + 1
+            clients[piece.id_order] = piece.id_client
+
+    finished = []
+    for id_order, counts in produced_by_order.items():
+        result = await db.execute(
+            update(models.OrderProgress)
+            .where(models.OrderProgress.id_order == id_order)
+            .values({
+                getattr(models.OrderProgress, column): getattr(models.OrderProgress, column) - number
+                for column, number in counts.items()
+            })
+            .returning(models.OrderProgress.remaining_a, models.OrderProgress.remaining_b)
+            .execution_options(synchronize_session=False)
+        )
+        progress = result.first()
+        if progress is not None:
+            order_finished = progress.remaining_a <= 0 and progress.remaining_b <= 0
+            if order_finished:
+                await db.execute(delete(models.OrderProgress).where(models.OrderProgress.id_order == id_order))
+        else:
+            # Orden asignada antes de existir order_progress
+            stmt = select(func.count()).select_from(models.Piece).where(
+                models.Piece.id_order == id_order,
+                models.Piece.status_piece == models.Piece.STATUS_QUEUED
+            )
+            order_finished = (await db.execute(stmt)).scalar_one() == 0
+        if order_finished:
+            finished.append({"id_order": id_order, "id_client": clients[id_order]})
+    await db.commit()
+    for piece in pieces:
+        stock_index.update(piece.id_piece, piece.piece_type, models.Piece.STATUS_PRODUCED, piece.id_order)
+    return finished
+
+
+async def release_order_pieces(db: AsyncSession, id_order):
+    """Unassign every piece of an order with a single UPDATE. Returns the number of released pieces."""
+    result = await db.execute(
+        update(models.Piece)
+        .where(models.Piece.id_order == id_order)
+        .values(id_order=None)
+        .returning(models.Piece.id_piece, models.Piece.piece_type, models.Piece.status_piece)
+        .execution_options(synchronize_session=False)
+    )
+    released = result.all()
+    await db.execute(delete(models.OrderProgress).where(models.OrderProgress.id_order == id_order))
+    await db.commit()
+    for id_piece, piece_type, status_piece in released:
+        stock_index.update(id_piece, piece_type, status_piece, None)
+    production_latency.forget([id_piece for id_piece, _, _ in released])
+    return len(released)
+
+
+async def set_order_pieces_status(db: AsyncSession, id_orders, status):
+    """Change the status of every piece of the given orders with a single UPDATE. Returns the number of pieces."""
+    values = {"status_piece": status}
+    if status == models.Piece.STATUS_PRODUCED:
+        values["manufacturing_date"] = func.now()
+    result = await db.execute(
+        update(models.Piece)
+        .where(models.Piece.id_order.in_(id_orders))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def request_pieces_production(piece_ids_by_type: dict, id_order=None, priority=PRIORITY_STOCK):
+    """Request the production of the pieces in chunks of PRODUCTION_REQUEST_CHUNK_SIZE.
+
+    The chunks go to the machine scheduler, or straight to the shared queues if it is disabled,
+    with the given AMQP priority (see production_priority).
+    """
+    chunks = [
+        (piece_type, piece_ids[start:start + PRODUCTION_REQUEST_CHUNK_SIZE])
+        for piece_type, piece_ids in piece_ids_by_type.items()
+        for start in range(0, len(piece_ids), PRODUCTION_REQUEST_CHUNK_SIZE)
+    ]
+    for piece_type, chunk in chunks:
+        production_latency.track(chunk, priority)
+    if MACHINE_SCHEDULER_ENABLED:
+        for piece_type, chunk in chunks:
+            machine_scheduler.submit(piece_type, chunk, id_order, priority)
+        return
+    await asyncio.gather(*(
+        publish(json.dumps({"id_pieces": chunk}), PIECE_REQUESTED_ROUTING_KEYS[piece_type], priority)
+        for piece_type, chunk in chunks
+    ))
+    async with SessionLocal() as db:
+        await mark_pieces_requested(db, [id_piece for _, chunk in chunks for id_piece in chunk])
+
+
+async def mark_pieces_requested(db: AsyncSession, piece_ids):
+    """Record that the production request of the queued pieces was just published to a machine queue."""
+    await db.execute(
+        update(models.Piece)
+        .where(models.Piece.id_piece.in_(piece_ids), models.Piece.status_piece == models.Piece.STATUS_QUEUED)
+        .values(requested_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+
+async def resubmit_queued_pieces(db: AsyncSession, undispatched: bool = True):
+    """Request again the production of the queued pieces whose request was lost.
+
+    requested_at is NULL while the request waits in the machine scheduler and is set when it is
+    published to a machine queue (see mark_pieces_requested). Pieces published more than
+    PRODUCTION_RESUBMIT_AFTER_SECONDS ago (e.g. to a machine that died) are resubmitted, and with
+    undispatched also the ones never published, which at startup were in the heap of the previous
+    process. Pieces produced twice are ignored by mark_pieces_produced.
+    """
+    now = datetime.utcnow()
+    stale = models.Piece.requested_at < now - timedelta(seconds=PRODUCTION_RESUBMIT_AFTER_SECONDS)
+    if undispatched:
+        stale = or_(models.Piece.requested_at.is_(None), stale)
+    stmt = (
+        select(
+            models.Piece.id_piece, models.Piece.piece_type, models.Piece.id_order,
+            models.Piece.id_client, models.Piece.creation_date
+        )
+        .where(models.Piece.status_piece == models.Piece.STATUS_QUEUED, stale)
+        .order_by(models.Piece.id_order, models.Piece.id_piece)
+    )
+    result = await db.execute(stmt)
+    by_order, orders = {}, {}
+    for id_piece, piece_type, id_order, id_client, creation_date in result:
+        by_order.setdefault(id_order, {}).setdefault(piece_type, []).append(id_piece)
+        if id_order is not None and id_order not in orders:
+            orders[id_order] = (id_client, creation_date)
+    if not by_order:
+        return 0
+    # Vuelven al heap del scheduler: sin requested_at hasta que se envien a una maquina
+    await db.execute(
+        update(models.Piece)
+        .where(models.Piece.status_piece == models.Piece.STATUS_QUEUED, stale)
+        .values(requested_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    for id_order, piece_ids_by_type in by_order.items():
+        priority = PRIORITY_STOCK
+        if id_order is not None:
+            id_client, creation_date = orders[id_order]
+            # Tamaño de lo que falta por producir; la antiguedad sube la clase
+            age_seconds = (now - creation_date.replace(tzinfo=None)).total_seconds() if creation_date else 0.0
+            pieces = sum(len(piece_ids) for piece_ids in piece_ids_by_type.values())
+            priority = production_priority(pieces, id_client, age_seconds)
+        await request_pieces_production(piece_ids_by_type, id_order, priority)
+    resubmitted = sum(
+        len(piece_ids) for piece_ids_by_type in by_order.values() for piece_ids in piece_ids_by_type.values()
+    )
+    logger.info("Resubmitted the production of %i queued pieces", resubmitted)
+    return resubmitted
+
+
+async def get_free_pieces(db: AsyncSession):
+    """Return (id_piece, piece_type, status_piece) of every piece not assigned to an order."""
+    stmt = select(models.Piece.id_piece, models.Piece.piece_type, models.Piece.status_piece).where(
+        models.Piece.id_order.is_(None)
+    )
+    result = await db.execute(stmt)
+    return result.all()
+
+
+async def rebuild_stock_index(db: AsyncSession):
+    """Load the free pieces into the stock index."""
+    stock_index.rebuild(await get_free_pieces(db))
+
+
+PIECE_FIELDS = ("id_piece", "piece_type", "manufacturing_date", "status_piece", "id_order", "id_client")
+
+
+def pieces_statement(id_order=None, free=False, piece_type=None, after_id=None, fields=PIECE_FIELDS):
+    """SELECT of the given piece columns (always including id_piece), sorted by id_piece.
+
+    free selects the pieces without order; otherwise id_order filters by order if given.
+    """
+    columns = [models.Piece.id_piece] + [getattr(models.Piece, field) for field in fields if field != "id_piece"]
+    stmt = select(*columns)
+    if free:
+        stmt = stmt.where(models.Piece.id_order.is_(None))
+    elif id_order is not None:
+        stmt = stmt.where(models.Piece.id_order == id_order)
+    if piece_type is not None:
+        stmt = stmt.where(models.Piece.piece_type == piece_type)
+    if after_id is not None:
+        stmt = stmt.where(models.Piece.id_piece > after_id)
+    return stmt.order_by(models.Piece.id_piece)
+
+
+async def get_pieces_page(db: AsyncSession, stmt, limit: int):
+    """Return up to `limit` rows of a pieces statement as dicts."""
+    result = await db.execute(stmt.limit(limit))
+    return [dict(row) for row in result.mappings().all()]
+
+
+async def stream_pieces(db: AsyncSession, stmt, batch_size: int = 500):
+    """Yield the rows of a pieces statement as dicts, fetching `batch_size` rows at a time."""
+    result = await db.stream(stmt.execution_options(yield_per=batch_size))
+    async for row in result.mappings():
+        yield dict(row)
+
+
+async def get_pieces_summary(db: AsyncSession):
+    """Number of pieces per type, status and assigned/free, with a single GROUP BY."""
+    assigned = models.Piece.id_order.is_not(None).label("assigned")
+    stmt = (
+        select(models.Piece.piece_type, models.Piece.status_piece, assigned, func.count().label("count"))
+        .group_by(models.Piece.piece_type, models.Piece.status_piece, assigned)
+    )
+    result = await db.execute(stmt)
+    return [
+        {
+            "piece_type": row.piece_type,
+            "status_piece": row.status_piece,
+            "assigned": bool(row.assigned),
+            "count": row.count
+        }
+        for row in result
+    ]
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Database models definitions. Table representations as class."""
-from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey
+from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Index, inspect, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -37,11 +37,49 @@ class Piece(BaseModel):
     STATUS_QUEUED = "Queued"
     STATUS_PRODUCED = "Produced"
     STATUS_DELIVERED = "Delivered"
+    STATUS_SHIPPED = "Shipped"
 
     __tablename__ = "pieces"
+    __table_args__ = (
+        Index("ix_pieces_id_order_piece_type", "id_order", "piece_type"),
+    )
     id_piece = Column(Integer, primary_key=True)
     piece_type = Column(String(256), nullable=False)
     manufacturing_date = Column(DateTime(timezone=True), server_default=None)
     status_piece = Column(String(256))
     id_order = Column(Integer, nullable=True)
-    id_client = Column(Integer, nullable=True)
\ No newline at end of file
+    id_client = Column(Integer, nullable=True)
+    # Ultimo envio de su peticion de produccion a una cola de maquina; NULL mientras espera en el scheduler
+    requested_at = Column(DateTime, nullable=True)
+
+
+class OrderProgress(BaseModel):
+    """Pieces of an order still waiting to be produced. Deleted when the order is produced."""
+    __tablename__ = "order_progress"
+    id_order = Column(Integer, primary_key=True)
+    id_client = Column(Integer, nullable=True)
+    remaining_a = Column(Integer, nullable=False, default=0)
+    remaining_b = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+
+    REMAINING_COLUMNS = {
+        "A": "remaining_a",
+        "B": "remaining_b"
+    }
+
+
+def add_missing_columns(connection):
+    """Add the nullable columns missing in existing tables (create_all only creates new tables)."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+def create_missing_indexes(connection):
+    """Create the indexes missing in existing tables (create_all only creates them with new tables)."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)